@@ -0,0 +1,280 @@
+"""Benchmarks for the beneficiaries pipeline on synthetic rosters.
+
+Google Places and openrouteservice are replaced by local stub HTTP servers
+with configurable latency, so runs need no network access or API keys.
+
+    python benchmark.py --sizes 100 1000 10000 --latency 0.05
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+import utils
+
+SIZES = [100, 1000, 10000]
+MEAL_OPTIONS = ['Regular', 'Vegetarian']
+SPREAD = 0.1
+
+
+def make_roster(path, size, meal_options=MEAL_OPTIONS, missing=0.0, seed=0):
+    """Write a beneficiaries workbook of `size` rows scattered around the
+    default vehicle start. A `missing` fraction of rows has no coordinates."""
+    import openpyxl as xl
+
+    rng = random.Random(seed)
+    wb = xl.Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(['Beneficiary Name', 'Address', 'Remarks', 'Longitude', 'Lattitude',
+               'Google Maps Name', 'Google Maps Address', *meal_options])
+    for i in range(size):
+        address = f'{rng.randint(1, 9999)} Synthetic St #{i}'
+        meals = [rng.choice([0, 1, 1, 2]) for _ in meal_options]
+        if rng.random() < missing:
+            ws.append([f'Beneficiary {i}', address, None, None, None, None, None, *meals])
+            continue
+        lat, lon = place_for(address)
+        ws.append([f'Beneficiary {i}', address, None, lon, lat,
+                   f'Place {i}', f'{address}, Ann Arbor, MI', *meals])
+    wb.save(path)
+
+
+def place_for(address):
+    """Deterministic coordinates near the default vehicle start."""
+    rng = random.Random(zlib.crc32(address.encode()))
+    lat, lon = utils.DEFAULT_START['location']
+    return (round(lat + rng.uniform(-SPREAD, SPREAD), utils.PRECISION),
+            round(lon + rng.uniform(-SPREAD, SPREAD), utils.PRECISION))
+
+
+def stub_optimization(body):
+    """Plan shaped like an ORS optimization response: jobs are swept by angle
+    around the depot and handed to vehicles until their capacity is used."""
+    jobs = body.get('jobs', [])
+    vehicles = body['vehicles']
+    geometry = body.get('options', {}).get('g', False)
+    depot = vehicles[0]['start']
+    angles = [np.arctan2(job['location'][1] - depot[1], job['location'][0] - depot[0])
+              for job in jobs]
+    order = list(np.argsort(angles, kind='stable'))
+    routes = []
+    for vehicle in vehicles:
+        capacity = np.asarray(vehicle.get('capacity', []))
+        load = np.zeros_like(capacity)
+        steps = []
+        while order:
+            job = jobs[order[0]]
+            amount = np.asarray(job.get('amount', np.zeros_like(capacity)))
+            if np.any(load + amount > capacity):
+                break
+            load = load + amount
+            steps.append(job)
+            order.pop(0)
+        if not steps:
+            continue
+        remaining = load.copy()
+        arrival = 0
+        route_steps = [{'type': 'start', 'location': vehicle['start'],
+                        'load': load.tolist(), 'arrival': 0, 'duration': 0}]
+        for job in steps:
+            arrival += 300
+            remaining = remaining - np.asarray(job.get('amount', 0))
+            route_steps.append({'type': 'job', 'id': job['id'], 'job': job['id'],
+                                'location': job['location'], 'load': remaining.tolist(),
+                                'arrival': arrival, 'duration': arrival,
+                                'service': job.get('service', 0)})
+            arrival += job.get('service', 0)
+        route_steps.append({'type': 'end', 'location': vehicle['end'],
+                            'load': remaining.tolist(), 'arrival': arrival + 300,
+                            'duration': arrival + 300})
+        route = {'vehicle': vehicle['id'], 'cost': 300 * (len(steps) + 1),
+                 'amount': load.tolist(), 'delivery': load.tolist(),
+                 'duration': 300 * (len(steps) + 1),
+                 'service': sum(job.get('service', 0) for job in steps),
+                 'steps': route_steps}
+        if geometry:
+            route['geometry'] = utils.encode_polyline([step['location'] for step in route_steps])
+        routes.append(route)
+    return {
+        'code': 0,
+        'summary': {'cost': sum(route['cost'] for route in routes),
+                    'unassigned': len(order)},
+        'unassigned': [{'id': jobs[j]['id'], 'location': jobs[j]['location']} for j in order],
+        'routes': routes,
+    }
+
+
+def stub_matrix(body):
+    locations = body['locations']
+    sources = body.get('sources', list(range(len(locations))))
+    destinations = body.get('destinations', list(range(len(locations))))
+    durations, distances = utils.haversine_matrix(locations)
+    return {'durations': durations[np.ix_(sources, destinations)].tolist(),
+            'distances': distances[np.ix_(sources, destinations)].tolist()}
+
+
+def stub_directions(body):
+    return {'routes': [{'geometry': utils.encode_polyline(body['coordinates'])}]}
+
+
+class StubServer:
+    """Local stand-in for the Google Places findplacefromtext endpoint and the
+    ORS optimization, matrix and directions endpoints, answering after
+    `latency` seconds."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path != '/maps/api/place/findplacefromtext/json':
+                    return self.reply(404, {})
+                address = parse_qs(url.query)['input'][0]
+                lat, lon = place_for(address)
+                self.reply(200, {'status': 'OK', 'candidates': [{
+                    'geometry': {'location': {'lat': lat, 'lng': lon}},
+                    'name': f'Place for {address}',
+                    'formatted_address': f'{address}, Ann Arbor, MI',
+                }]})
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                if self.path == '/optimization':
+                    return self.reply(200, stub_optimization(body))
+                if self.path.startswith('/v2/matrix/'):
+                    return self.reply(200, stub_matrix(body))
+                if self.path.startswith('/v2/directions/'):
+                    return self.reply(200, stub_directions(body))
+                self.reply(404, {})
+
+            def reply(self, status, payload):
+                stub.requests += 1
+                time.sleep(stub.latency)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def measure(stage, fn, memory=True):
+    """Run `fn` quietly; returns its result and a report row for `stage`."""
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = fn()
+    seconds = time.perf_counter() - start
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return result, {'stage': stage, 'seconds': seconds, 'peak_mb': peak}
+
+
+def run(size, stub, args):
+    """Time every pipeline stage on a synthetic roster of `size` stops."""
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            make_roster('roster.xlsx', size, missing=args.missing, seed=args.seed)
+            capacities = {meal: args.capacity for meal in MEAL_OPTIONS}
+            vehicles = max(1, int(np.ceil(size * 1.5 / args.capacity)))
+            util, row = measure('load', lambda: utils.Util(
+                'stub-key', None, None, vehicles, capacities, args.time_limit, 300,
+                geocode_cache=utils.GeocodeCache(':memory:'), geocode_qps=args.qps,
+                geometry_cache=utils.GeocodeCache(':memory:', ttl=None),
+                storage=utils.LocalStorage('roster.xlsx'),
+                ors_base_url=stub.url), args.memory)
+            rows.append(row)
+            if args.missing > 0:
+                rows.append(measure('update_coords', util.update_coords, args.memory)[1])
+            rows.append(measure('display', util.display_beneficiaries, args.memory)[1])
+            rows.append(measure('display compact',
+                                lambda: util.display_beneficiaries(compact=True),
+                                args.memory)[1])
+            for solver in args.solvers:
+                util.solver = solver
+                rows.append(measure(f'route {solver}',
+                                    lambda: util.route(compact=True, clusters=args.clusters),
+                                    args.memory)[1])
+        finally:
+            os.chdir(cwd)
+    for row in rows:
+        row['size'] = size
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds each stub API request takes')
+    parser.add_argument('--missing', type=float, default=0.1,
+                        help='fraction of rows without coordinates to geocode')
+    parser.add_argument('--qps', type=float, default=utils.GEOCODE_QPS,
+                        help='geocoding rate limit')
+    parser.add_argument('--solvers', nargs='+', default=['ors'], choices=['ors', 'local'],
+                        help='solver backends to route with; the local solver '
+                             'keeps a dense travel time matrix in memory')
+    parser.add_argument('--clusters', type=int, default=None)
+    parser.add_argument('--capacity', type=int, default=40)
+    parser.add_argument('--time-limit', type=int, default=8 * 3600)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='skip tracemalloc, which slows every stage down')
+    parser.add_argument('--json', default=None, help='also write the report to this file')
+    args = parser.parse_args(argv)
+
+    rows = []
+    with StubServer(args.latency) as stub:
+        utils.GOOGLE_PLACES_URL = stub.url + '/maps/api/place/findplacefromtext/json'
+        for size in args.sizes:
+            rows += run(size, stub, args)
+    print(f'{"size":>7}  {"stage":<16} {"seconds":>9} {"peak MB":>9}')
+    for row in rows:
+        peak = '' if row['peak_mb'] is None else f'{row["peak_mb"]:9.1f}'
+        print(f'{row["size"]:>7}  {row["stage"]:<16} {row["seconds"]:9.3f} {peak:>9}')
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,21 +1,73 @@
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import json
+import re
+import time
+import sqlite3
+import threading
+import zlib
+import hashlib
+import zipfile
+from xml.sax.saxutils import escape as xml_escape
+import os
+import random
+import shutil
+import argparse
 import colorsys
+import contextlib
 import pandas as pd
 import numpy as np
-import openpyxl as xl
-import folium
-import openrouteservice as ors
-from openrouteservice import optimization as opt
-from multiset import Multiset
-
-from pydrive.auth import GoogleAuth
-from pydrive.drive import GoogleDrive
-from google.colab import drive
-from google.colab import auth
-from oauth2client.client import GoogleCredentials
+
+# folium, openrouteservice, openpyxl and the Colab / Drive client
+# libraries are imported where they are used, so routing-only and headless
+# runs do not pay for them at start-up.
 
 BENEFICIARIES_XLSX = 'beneficiaries.xlsx'
+GOOGLE_PLACES_URL = 'https://maps.googleapis.com/maps/api/place/findplacefromtext/json'
+NOMINATIM_URL = 'https://nominatim.openstreetmap.org/search'
+GEOCODE_CACHE_DB = 'geocode_cache.sqlite'
+GEOCODE_CACHE_TTL = 90 * 24 * 3600
+GEOCODE_CACHE_SIZE = 100000
+GEOCODE_WORKERS = 8
+GEOCODE_QPS = 10
+GEOCODE_RETRIES = 4
+GEOCODE_BACKOFF = 0.5
+GEOCODE_TIMEOUT = 30
+GEOCODE_JOURNAL = 'geocode_journal.jsonl'
+GEOCODE_CHECKPOINT = 25
+ADDRESS_MATCH_THRESHOLD = 0.9
+LOCAL_SPEED = 40 / 3.6
+LOCAL_DETOUR = 1.3
+LOCAL_SEARCH_TIME = 10
+LOCAL_SEARCH_STALL = 1000
+LOCAL_SEARCH_SLACK = 0.01
+LOCAL_RUIN_SIZE = (5, 20)
+EARTH_RADIUS = 6371008.8
+EPS = 1e-6
+HEADER_SKETCH_BITS = 12
+LAST_PLAN_JSON = 'last_plan.json'
+PLAN_CACHE_DIR = 'plan_cache'
+PLAN_CACHE_SIZE = 50
+REOPT_MAX_CHANGE = 0.2
+REOPT_MAX_DEGRADATION = 0.1
+MATRIX_DIR = 'matrix_cache'
+MATRIX_TILE = 50
+MATRIX_WORKERS = 4
+SWEEP_WORKERS = 4
+MIN_FEASIBLE_PARAMS = ('number_of_vehicles', 'time_limit')
+GEOMETRY_WORKERS = 4
+GEOMETRY_CACHE_DB = 'geometry_cache.sqlite'
+GEOMETRY_CACHE_SIZE = 10000
+DIRECTIONS_MAX_WAYPOINTS = 50
+COALESCE_RADIUS = 25
+COALESCE_ADDRESS_RADIUS = 100
+COALESCE_SERVICE_SCALE = 0.5
+WALK_SPEED = 1.2
+EXPORT_DIR = 'routes'
+EXPORT_WORKERS = 4
+DETAIL_ZOOM = 16
+METRICS_PREFIX = 'beneficiaries'
 DEFAULT_START = {
     'location': [42.23545, -83.73750],
     'name': 'Ann Arbor Meals on Wheels',
@@ -62,6 +114,79 @@ html::-webkit-scrollbar-thumb:active {
 
 </style></head>
 '''
+POPUP_STYLE = \
+'''
+.leaflet-popup-content {
+    font-family: Calibri;
+    color: #DDDDDD;
+    max-height: 300px;
+    overflow-y: auto;
+}
+.leaflet-popup-content h2, .leaflet-popup-content h3 {
+    margin-block-end: 0;
+    color: #DDDDDD;
+}
+'''
+ADDRESS_ABBREVIATIONS = {
+    'st': 'street', 'ave': 'avenue', 'av': 'avenue', 'rd': 'road', 'dr': 'drive',
+    'blvd': 'boulevard', 'ln': 'lane', 'ct': 'court', 'pl': 'place', 'cir': 'circle',
+    'pkwy': 'parkway', 'hwy': 'highway', 'trl': 'trail', 'ter': 'terrace', 'sq': 'square',
+    'n': 'north', 's': 'south', 'e': 'east', 'w': 'west',
+    'ne': 'northeast', 'nw': 'northwest', 'se': 'southeast', 'sw': 'southwest',
+}
+ADDRESS_UNITS = {'#', 'apt', 'apartment', 'unit', 'ste', 'suite', 'rm', 'room', 'fl',
+                 'floor', 'bldg', 'building', 'lot'}
+BENEFICIARY_CALLBACK = \
+'''
+function (row) {
+    var options = %s;
+    var meals = '';
+    for (var i = 0; i < options.length; i++) {
+        meals += options[i] + ': ' + row[6][i] + '<br/>';
+    }
+    var marker = L.marker(new L.LatLng(row[0], row[1]));
+    marker.bindPopup('<h3>' + row[2] + '</h3>' + row[3] +
+                     '<h3>Meals</h3>' + meals +
+                     '<h3>Location Data</h3>' +
+                     'Google Maps Name: ' + row[4] + '<br/>' +
+                     'Google Maps Address: ' + row[5] + '<br/>' +
+                     row[0] + ' °N, ' + row[1] + ' °E');
+    return marker;
+}
+'''
+STOP_CALLBACK = \
+'''
+function (row) {
+    var options = %s;
+    var meals = '';
+    var carry = '';
+    for (var i = 0; i < options.length; i++) {
+        meals += options[i] + ': ' + row[5][i] + '<br/>';
+        carry += options[i] + ': ' + row[7][i] + '<br/>';
+    }
+    var marker = L.circleMarker(new L.LatLng(row[0], row[1]),
+                                {radius: 7, color: '#000000', weight: 1,
+                                 fillColor: row[8], fillOpacity: 0.9});
+    marker.bindPopup('<h2>Vehicle ' + row[2] + '</h2>' +
+                     '<h3>' + row[3] + '</h3>' + row[4] +
+                     '<h3>Meals</h3>' + meals + '<br/>' +
+                     'Arrive in ' + row[6] + '<br/>' +
+                     'Leave carrying<br/>' + carry + '<br/>' +
+                     row[0] + ' °N, ' + row[1] + ' °E');
+    return marker;
+}
+'''
+UNASSIGNED_CALLBACK = \
+'''
+function (row) {
+    var marker = L.circleMarker(new L.LatLng(row[0], row[1]),
+                                {radius: 7, color: '#000000', weight: 1,
+                                 fillColor: '#d63e2a', fillOpacity: 0.9});
+    marker.bindPopup('<h3>' + row[2] + '</h3>' + row[3]);
+    return marker;
+}
+'''
+
 
 class Util:
     
@@ -73,7 +198,20 @@ class Util:
                  capacities,
                  time_limit,
                  stop_time,
-                 vehicle_start=None):
+                 vehicle_start=None,
+                 geocode_cache=None,
+                 geocode_workers=GEOCODE_WORKERS,
+                 geocode_qps=GEOCODE_QPS,
+                 solver='ors',
+                 matrix=None,
+                 storage=None,
+                 ors_base_url=None,
+                 metrics=None,
+                 coalesce_radius=None,
+                 coalesce_service_scale=COALESCE_SERVICE_SCALE,
+                 plan_cache=None,
+                 address_match_threshold=ADDRESS_MATCH_THRESHOLD,
+                 geometry_cache=None):
         self.gkey = google_key
         self.okey = ors_key
         self.beneficiaries_file_id = beneficiaries_file_id
@@ -84,38 +222,69 @@ class Util:
         self.stop_time = stop_time
         self.vehicle_start = vehicle_start if vehicle_start is not None else DEFAULT_START
         self.num_api_calls = 0
+        self.geocache = geocode_cache if geocode_cache is not None else default_geocode_cache()
+        self.geocode_workers = geocode_workers
+        self.rate_limiter = RateLimiter(geocode_qps)
+        self.session = pooled_session(geocode_workers)
+        self.api_lock = threading.Lock()
+        self.solver = solver
+        self.matrix = matrix
+        self.ors_base_url = ors_base_url
+        self.coalesce_radius = coalesce_radius
+        self.coalesce_service_scale = coalesce_service_scale
+        self.plan_cache = plan_cache if plan_cache is not None else PlanCache()
+        self.address_match_threshold = address_match_threshold
+        self.geometry_cache = geometry_cache
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.metrics.track(self.session)
         
-        auth.authenticate_user()
-        gauth = GoogleAuth()
-        gauth.credentials = GoogleCredentials.get_application_default()
-        self.gdrive = GoogleDrive(gauth)
+        self.storage = storage if storage is not None else \
+            DriveStorage(beneficiaries_file_id, metrics=self.metrics)
         
-        print(f'Downloading beneficiaries file {beneficiaries_file_id}...')
-        beneficiaries_file = self.gdrive.CreateFile({'id':beneficiaries_file_id})
-        beneficiaries_file.GetContentFile(BENEFICIARIES_XLSX)
-        
-        print(f'Reading file format...')
-        df = pd.read_excel(BENEFICIARIES_XLSX)
-        self.nam_c = get_col(df, 'beneficiary name')
-        self.adr_c = get_col(df, 'address')
-        self.rmk_c = get_col(df, 'remarks')
-        self.lon_c = get_col(df, 'longitude')
-        self.lat_c = get_col(df, 'lattitude')
-        self.gname_c = get_col(df, 'google maps name')
-        self.gaddr_c = get_col(df, 'google maps address')
+        with self.metrics.stage('load'):
+            print(f'Downloading beneficiaries file {self.storage.name}...')
+            self.storage.download(BENEFICIARIES_XLSX)
+            
+            print(f'Reading file format...')
+            df = pd.read_excel(BENEFICIARIES_XLSX)
+        with self.metrics.stage('validate'):
+            self.validate(df)
+    
+    
+    def validate(self, df):
+        """Locate the expected columns of the sheet `df` and parse it."""
+        self.header_match = HeaderMatcher(df.columns).match(
+            ['beneficiary name', 'address', 'remarks', 'longitude', 'lattitude',
+             'google maps name', 'google maps address', *self.meal_options])
+        self.nam_c = self.header_match['beneficiary name']['column']
+        self.adr_c = self.header_match['address']['column']
+        self.rmk_c = self.header_match['remarks']['column']
+        self.lon_c = self.header_match['longitude']['column']
+        self.lat_c = self.header_match['lattitude']['column']
+        self.gname_c = self.header_match['google maps name']['column']
+        self.gaddr_c = self.header_match['google maps address']['column']
         self.meal_options_c = np.full(len(self.meal_options), -1, dtype=int)
         for i,meal in enumerate(self.meal_options):
-            col = get_col(df, meal)
+            col = self.header_match[meal]['column']
             if col is None:
                 print(f'{red("ERROR:")} No matching column for the meal option '
                       f'{red(meal)} was found. '
-                      f'Did you mean {yellow(df.columns[get_col(df, meal, threshold=0)])}?')
+                      f'Did you mean {yellow(self.header_match[meal]["suggestions"][0])}?')
                 continue
             self.meal_options_c[i] = col
             print(f'Meal option {green(meal)} found in column '
                   f'{green(get_excel_column_letter(col))}.')
         self.valid = True
         self.check_format_valid()
+        self._table = BeneficiaryTable.from_columns(df, self) if self.valid else None
+    
+    
+    @property
+    def table(self):
+        """The parsed beneficiaries sheet, re-read only after update_coords writes."""
+        if self._table is None:
+            self._table = BeneficiaryTable.from_columns(pd.read_excel(BENEFICIARIES_XLSX), self)
+        return self._table
     
     
     def check_format_valid(self):
@@ -139,9 +308,11 @@ class Util:
         ]
         for col_name, col in zip(col_names, cols):
             if col is None:
+                suggestions = self.header_match[col_name.lower()]['suggestions']
                 print(f'{red("ERROR:")} No matching column for '
                       f'{red(col_name)} was found. '
-                      'Please check the format of the beneficiaries file.')
+                      'Please check the format of the beneficiaries file.'
+                      + (f' Did you mean {yellow(suggestions[0])}?' if suggestions else ''))
                 self.valid = False
             else:
                 print(f'{green(col_name)} found in column '
@@ -155,46 +326,53 @@ class Util:
                   f'{red("invalid")}. Please correct it to proceed.')
     
     
-    def update_coords(self):
+    def update_coords(self, cancel=None):
+        """Look up the coordinates of beneficiaries missing them and show the
+        updated map. Progress is journaled; see geocode_events."""
         if not self.valid:
             return
         
-        before_api_calls = self.num_api_calls
+        with self.metrics.stage('geocode'):
+            if not self.geocode(cancel):
+                return
         
-        df = pd.read_excel(BENEFICIARIES_XLSX)
-        wb = xl.load_workbook(BENEFICIARIES_XLSX)
-        ws = wb.worksheets[0]
-        errors = []
+        with self.metrics.stage('render'):
+            return self.display_beneficiaries()
+    
+    
+    def geocode(self, cancel=None):
+        """Print the progress of geocode_events. Returns False if cancelled."""
         print('')
-        for row in ws.rows:
-            if row[self.adr_c].value is not None and \
-                (row[self.lon_c].value is None or row[self.lat_c].value is None):
-                input_addr = row[self.adr_c].value
-                print(f'\r{yellow(f"Looking up the coordinates for {input_addr}...")}'
-                      '                                                 '
-                      '                                                 ',
-                      end='')
-                response = self.google_places_search(input_addr)
-                try:
-                    gplace = extract_google_place(response)
-                    row[self.lon_c].value = gplace['longitude']
-                    row[self.lat_c].value = gplace['lattitude']
-                    row[self.gname_c].value = gplace['name']
-                    row[self.gaddr_c].value = gplace['address']
-                except ValueError:
-                    errors.append([row[self.nam_c].value, row[self.adr_c].value])
+        with contextlib.closing(self.geocode_events(cancel)) as events:
+            for event in events:
+                if event['type'] == 'start' and event['resumed'] > 0:
+                    print(f'Resuming: {green(event["resumed"])} of {event["total"]} '
+                          'beneficiaries were already looked up.')
+                if event['type'] == 'start' and event['local'] > 0:
+                    print(f'{green(event["local"])} addresses matched previously '
+                          'geocoded beneficiaries.')
+                elif event['type'] == 'progress':
+                    total = event['total']
+                    print(f'\r{yellow(f"Looking up the coordinates for {total} addresses... ")}'
+                          f'{event["done"]}/{total}',
+                          end='')
+                elif event['type'] == 'cancelled':
+                    print(f'\r{yellow("WARNING:")} Geocoding cancelled after '
+                          f'{event["resolved"]} of {event["total"]} beneficiaries. '
+                          'Run it again to continue where it stopped.')
+                    return False
+                elif event['type'] == 'done':
+                    done = event
         print('\r                                                               '
               '                                                                 ',
               end='')
-        num_api_calls = self.num_api_calls - before_api_calls
-        if num_api_calls > 0:
-            wb.save(BENEFICIARIES_XLSX)
-            beneficiaries_file = self.gdrive.CreateFile({'id': self.beneficiaries_file_id})
-            beneficiaries_file.SetContentFile(BENEFICIARIES_XLSX)
-            beneficiaries_file.Upload()
+        if done['upload_error'] is not None:
+            print(f'\r{red("ERROR:")} {done["upload_error"]}')
                       
-        print(f'\r{yellow(num_api_calls)} Google Places API calls made.')
+        print(f'\r{yellow(done["api_calls"])} Google Places API calls made, '
+              f'{green(done["cache_hits"])} addresses found in the geocode cache.')
         
+        errors = done['errors']
         if len(errors) > 0:
             print(f'{red("ERROR:")} The addresses for the following {len(errors)} beneficiaries '
                   'do not match any known places on Google Maps.\n'
@@ -204,9 +382,159 @@ class Util:
                 print(f'\t{i+1:3d}.\t{err[0]}: {err[1]}')
         
         print('')
-        return self.display_beneficiaries()
+        return True
+    
+    
+    def geocode_events(self, cancel=None, journal=GEOCODE_JOURNAL, checkpoint=GEOCODE_CHECKPOINT):
+        """Geocode every beneficiary missing coordinates, yielding progress
+        events as dicts with a `type`: start, progress, checkpoint, then
+        cancelled or done.
+        
+        Resolved rows are appended to `journal` every `checkpoint` lookups,
+        and rows found there with an unchanged address are not looked up
+        again, so an interrupted run resumes where it stopped. Setting the
+        `cancel` event, or closing the generator, stops after the lookups in
+        flight. Once all rows are resolved, the workbook is written and
+        uploaded and the journal removed.
+        
+        Addresses matching a geocoded beneficiary's address or Google Maps
+        address with a similarity of at least `address_match_threshold` are
+        resolved locally, without a Places lookup."""
+        before_api_calls = self.num_api_calls
+        before_cache_hits = self.geocache.hits
+        
+        pending = self.rows_missing_coords()
+        resolved = read_geocode_journal(journal, pending)
+        rows_of = {}
+        for r, name, addr in pending:
+            if r not in resolved:
+                rows_of.setdefault(normalize_address(addr), []).append((r, name, addr))
+        resumed = len(resolved)
+        
+        unsaved = []
+        errors = []
+        cancelled = False
+        
+        def resolve(key, response):
+            for r, name, addr in rows_of[key]:
+                try:
+                    place = extract_google_place(response)
+                except ValueError:
+                    place = None
+                if response.get('status') in ('OK', 'ZERO_RESULTS'):
+                    resolved[r] = {'row': r, 'name': name, 'address': str(addr), 'place': place}
+                    unsaved.append(resolved[r])
+                elif place is None:
+                    errors.append([name, addr])
+        
+        num_local = 0
+        if self.address_match_threshold is not None and len(rows_of) > 0:
+            index = self.address_index()
+            for key in list(rows_of):
+                place = index.match(rows_of[key][0][2], self.address_match_threshold)
+                if place is None:
+                    continue
+                for r, name, addr in rows_of.pop(key):
+                    resolved[r] = {'row': r, 'name': name, 'address': str(addr), 'place': place}
+                    unsaved.append(resolved[r])
+                num_local += 1
+        yield {'type': 'start', 'total': len(pending), 'resumed': resumed,
+               'local': num_local, 'lookups': len(rows_of)}
+        
+        executor = ThreadPoolExecutor(max_workers=self.geocode_workers)
+        futures = {executor.submit(self.google_places_search, rows_of[key][0][2]): key
+                   for key in rows_of}
+        consumed = set()
+        try:
+            for n, future in enumerate(as_completed(futures)):
+                key = futures[future]
+                consumed.add(future)
+                resolve(key, future.result())
+                yield {'type': 'progress', 'done': n + 1, 'total': len(futures),
+                       'address': rows_of[key][0][2]}
+                if len(unsaved) >= checkpoint:
+                    append_geocode_journal(journal, unsaved)
+                    unsaved.clear()
+                    yield {'type': 'checkpoint', 'resolved': len(resolved)}
+                if cancel is not None and cancel.is_set():
+                    cancelled = True
+                    break
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            # Keep lookups that finished after the last one consumed.
+            for future, key in futures.items():
+                if future not in consumed and future.done() and not future.cancelled() \
+                    and future.exception() is None:
+                    resolve(key, future.result())
+            append_geocode_journal(journal, unsaved)
+        if cancelled:
+            yield {'type': 'cancelled', 'resolved': len(resolved), 'total': len(pending)}
+            return
+        
+        updates = {}
+        for entry in resolved.values():
+            if entry['place'] is None:
+                errors.append([entry['name'], entry['address']])
+                continue
+            r = entry['row']
+            updates[r, self.lon_c] = entry['place']['longitude']
+            updates[r, self.lat_c] = entry['place']['lattitude']
+            updates[r, self.gname_c] = entry['place']['name']
+            updates[r, self.gaddr_c] = entry['place']['address']
+        upload_error = None
+        if len(updates) > 0:
+            write_cells(BENEFICIARIES_XLSX, updates)
+            self._table = None
+            try:
+                self.storage.upload(BENEFICIARIES_XLSX)
+            except OSError as e:
+                upload_error = str(e)
+        if os.path.exists(journal):
+            os.remove(journal)
+        yield {'type': 'done',
+               'total': len(pending),
+               'updated': len(updates) // 4,
+               'errors': errors,
+               'api_calls': self.num_api_calls - before_api_calls,
+               'cache_hits': self.geocache.hits - before_cache_hits,
+               'local_matches': num_local,
+               'upload_error': upload_error}
 
 
+    def address_index(self):
+        """AddressIndex of the addresses and Google Maps addresses of every
+        beneficiary with coordinates."""
+        table = self.table
+        index = AddressIndex()
+        for i in np.flatnonzero(np.isfinite(table.lat) & np.isfinite(table.lon)):
+            place = {'longitude': float(table.lon[i]),
+                     'lattitude': float(table.lat[i]),
+                     'name': cell_text(table.gnames[i]),
+                     'address': cell_text(table.gaddrs[i])}
+            index.add(cell_text(table.addresses[i]), place)
+            index.add(cell_text(table.gaddrs[i]), place)
+        return index
+    
+    
+    def rows_missing_coords(self):
+        """(Excel row, name, address) of every beneficiary with an address but
+        no coordinates, found in one read-only pass over the sheet."""
+        import openpyxl as xl
+        
+        wb = xl.load_workbook(BENEFICIARIES_XLSX, read_only=True)
+        try:
+            pending = []
+            cell = lambda row, c: row[c] if c < len(row) else None
+            for r, row in enumerate(wb.worksheets[0].iter_rows(min_row=2, values_only=True),
+                                    start=2):
+                if cell(row, self.adr_c) is not None and \
+                    (cell(row, self.lon_c) is None or cell(row, self.lat_c) is None):
+                    pending.append((r, cell(row, self.nam_c), cell(row, self.adr_c)))
+            return pending
+        finally:
+            wb.close()
+    
+    
     def google_places_extract_query(self, query):
         """Convert to route format."""
         if isinstance(query, str):
@@ -220,38 +548,52 @@ class Util:
 
 
     def google_places_search(self,arg):
-        route = 'https://maps.googleapis.com/maps/api/place/findplacefromtext/json'
-        self.num_api_calls += 1
-        return requests.get(route, params=self.google_places_extract_query(arg)).json()
+        cached = self.geocache.get('google_places', arg)
+        if cached is not None:
+            return cached
+        route = GOOGLE_PLACES_URL
+        params = self.google_places_extract_query(arg)
+        with self.metrics.call('google_places') as call:
+            for attempt in range(GEOCODE_RETRIES + 1):
+                with self.metrics.waiting():
+                    if attempt > 0:
+                        time.sleep(GEOCODE_BACKOFF * 2**(attempt-1) * (1 + random.random()))
+                    self.rate_limiter.wait()
+                with self.api_lock:
+                    self.num_api_calls += 1
+                try:
+                    r = self.session.get(route, params=params, timeout=GEOCODE_TIMEOUT)
+                except (requests.ConnectionError, requests.Timeout):
+                    if attempt < GEOCODE_RETRIES:
+                        continue
+                    raise
+                if r.status_code >= 500 and attempt < GEOCODE_RETRIES:
+                    continue
+                response = r.json()
+                if response.get('status') in ('OVER_QUERY_LIMIT', 'UNKNOWN_ERROR') and \
+                    attempt < GEOCODE_RETRIES:
+                    continue
+                break
+            call['status'] = response.get('status', r.status_code)
+            call['ok'] = response.get('status') in ('OK', 'ZERO_RESULTS')
+        if response.get('status') in ('OK', 'ZERO_RESULTS'):
+            self.geocache.put('google_places', arg, response)
+        return response
     
     
-    def marker_from_row(self, row):
-        name = row[self.nam_c]
-        addr = row[self.adr_c]
-        
-        try:
-            lat = round(float(row[self.lat_c]),PRECISION)
-        except ValueError:
-            print(f'{red("ERROR:")} The lattitude of {name}\'s address has a formatting error. '
-                  f'[{red(row[self.lat_c])}]')
-        
-        try:
-            lon = round(float(row[self.lon_c]),PRECISION)
-        except ValueError:
-            print(f'{red("ERROR:")} The longitude of {name}\'s address has a formatting error. '
-                  f'[{red(row[self.lon_c])}]')
-            
-        meals = ''
-        for mo,mc in zip(self.meal_options, self.meal_options_c):
-            try:
-                meals += f'{mo}: {int(row[mc])}<br/>'
-            except ValueError:
-                print(f'{red("ERROR:")} The number of {mo}s for {name}'
-                      ' has a formatting error. '
-                      f'[{red(row[mc])}]')
+    def marker_from_row(self, i):
+        """Map marker for the beneficiary at row `i` of the table."""
+        import folium
         
-        g_name = row[self.gname_c]
-        g_addr = row[self.gaddr_c]
+        table = self.table
+        name = table.names[i]
+        addr = table.addresses[i]
+        lat = table.lat[i]
+        lon = table.lon[i]
+        meals = ''.join(f'{mo}: {num_meal}<br/>'
+                        for mo,num_meal in zip(self.meal_options, table.meals[i]))
+        g_name = table.gnames[i]
+        g_addr = table.gaddrs[i]
         iframe = folium.IFrame(f'{STYLE}'
                                f'<h3>{name}</h3>{addr}'
                                f'<h3>Meals</h3>{meals}'
@@ -266,92 +608,534 @@ class Util:
                              popup=popup)
     
     
-    def job_from_row(self, row):
-        name = row[self.nam_c]
-        
-        try:
-            lat = round(float(row[self.lat_c]),PRECISION)
-        except ValueError:
-            print(f'{red("ERROR:")} The lattitude of {name}\'s address has a formatting error. '
-                  f'[{red(row[self.lat_c])}]')
-        
-        try:
-            lon = round(float(row[self.lon_c]),PRECISION)
-        except ValueError:
-            print(f'{red("ERROR:")} The longitude of {name}\'s address has a formatting error. '
-                  f'[{red(row[self.lon_c])}]')
-            
-        meals = []
-        for mo,mc in zip(self.meal_options, self.meal_options_c):
-            try:
-                num_meal = int(row[mc])
-                meals.append(num_meal)
-            except ValueError:
-                print(f'{red("ERROR:")} The number of {mo}s for {name}'
-                      ' has a formatting error. '
-                      f'[{red(row[mc])}]')
-                self.valid = False
+    def job_from_row(self, i, stop_time=None):
+        """Optimization job for the beneficiary at row `i` of the table."""
+        table = self.table
         return {
-            'location': [lon, lat],
-            'amount': meals,
-            'service': self.stop_time,
+            'location': [float(table.lon[i]), float(table.lat[i])],
+            'amount': [int(num_meal) for num_meal in table.meals[i]],
+            'service': self.stop_time if stop_time is None else stop_time,
         }
     
     
-    def display_beneficiaries(self):
-        m = folium.Map(**DEFAULT_MAP)
-        set_popup_background(m)
+    def vehicles(self, number_of_vehicles=None, time_limit=None, capacities=None):
+        """Optimization vehicles, by default as configured. `capacities` may
+        override some of the meal options only."""
+        number_of_vehicles = self.num_vehicles if number_of_vehicles is None \
+            else number_of_vehicles
+        time_limit = self.time_limit if time_limit is None else time_limit
+        capacities = {**self.capacities, **(capacities or {})}
+        return [
+            {'id': i,
+             'profile': 'driving-car',
+             'start': list(reversed(self.vehicle_start['location'])),
+             'end': list(reversed(self.vehicle_start['location'])),
+             'time_window': [0, time_limit],
+             'capacity': [capacities[meal] for meal in self.meal_options]}
+            for i in range(number_of_vehicles)
+            ]
+    
+    
+    def start_marker(self):
+        import folium
+        
         s_iframe = folium.IFrame(f'{STYLE}'
                                  f'<h3>Vehicle Start</h3>{self.vehicle_start["name"]}<br/>'
                                  f'{self.vehicle_start["location"][0]} °N, '
                                  f'{self.vehicle_start["location"][1]} °E',
                                  width=300,
                                  height=100)
-        folium.Marker(location=self.vehicle_start['location'],
-                      popup=folium.Popup(s_iframe, max_width=1000),
-                      icon=folium.Icon(color='black',
-                                       icon='home')).add_to(m)
-        df = pd.read_excel(BENEFICIARIES_XLSX)
-        for _,row in df.iterrows():
-            self.marker_from_row(row).add_to(m)
+        return folium.Marker(location=self.vehicle_start['location'],
+                             popup=folium.Popup(s_iframe, max_width=1000),
+                             icon=folium.Icon(color='black',
+                                              icon='home'))
+    
+    
+    def display_beneficiaries(self, compact=False):
+        """Map of all beneficiaries. With `compact`, they are emitted as one
+        clustered marker layer whose popups are built in the browser."""
+        import folium
+        from folium.plugins import FastMarkerCluster
+        
+        m = folium.Map(**DEFAULT_MAP)
+        set_popup_background(m)
+        self.start_marker().add_to(m)
+        table = self.table
+        table.print_errors()
+        valid = np.flatnonzero(table.valid)
+        if compact:
+            set_popup_style(m)
+            data = [[float(table.lat[i]), float(table.lon[i]),
+                     cell_text(table.names[i]), cell_text(table.addresses[i]),
+                     cell_text(table.gnames[i]), cell_text(table.gaddrs[i]),
+                     [int(x) for x in table.meals[i]]]
+                    for i in valid]
+            FastMarkerCluster(data,
+                              callback=BENEFICIARY_CALLBACK % json.dumps(list(self.meal_options))
+                              ).add_to(m)
+            return m
+        for i in valid:
+            self.marker_from_row(i).add_to(m)
         return m
     
     
-    def route(self):
+    def ors_client(self):
+        import openrouteservice as ors
+        requests_kwargs = {'hooks': {'response': [self.metrics.count_attempt]}}
+        if self.ors_base_url is None:
+            return ors.Client(key=self.okey, requests_kwargs=requests_kwargs)
+        return ors.Client(key=self.okey, base_url=self.ors_base_url,
+                          requests_kwargs=requests_kwargs)
+    
+    
+    def get_solver(self):
+        if self.solver == 'ors':
+            return ORSSolver(self.ors_client(), metrics=self.metrics)
+        if self.solver == 'local':
+            return LocalSolver(matrix=self.get_matrix())
+        return self.solver
+    
+    
+    def get_matrix(self):
+        """Travel time source for local solving: straight-line estimates by
+        default, or a shared on-disk ORS matrix when `matrix='ors'`."""
+        if self.matrix is None:
+            return haversine_matrix
+        if self.matrix == 'ors':
+            self.matrix = MatrixService(self.ors_client(), metrics=self.metrics)
+        return self.matrix
+    
+    
+    def route(self,
+              clusters=None,
+              incremental=False,
+              compact=False,
+              simplify=False,
+              force=False):
+        """Solve and render the delivery plan. With `clusters`, beneficiaries
+        are split into that many angular sectors around the vehicle start,
+        solved concurrently and merged. With `incremental`, the last plan is
+        updated in place for the beneficiaries that changed since, unless the
+        changes are too large. With `compact`, stops are drawn as one marker
+        layer whose popups are built in the browser. With `simplify`, route
+        lines are thinned to what is visible at the default zoom.
+        
+        Plans are cached by their inputs, so re-running with an unchanged
+        roster and fleet only renders again; `force` solves anew."""
+        optimized = self.get_plan(clusters, incremental, force)
+        if optimized is None:
+            return
+        with self.metrics.stage('render'):
+            return self.render_plan(optimized, compact, simplify)
+    
+    
+    def get_plan(self, clusters=None, incremental=False, force=False):
+        """Delivery plan for the current roster and fleet, from the plan cache
+        unless `force` is set. See route."""
         if not self.valid:
             return
         
-        client = ors.Client(key=self.okey)
-        vehicles = [
-            opt.Vehicle(id=i, profile='driving-car',
-                        start=list(reversed(self.vehicle_start['location'])),
-                        end=list(reversed(self.vehicle_start['location'])),
-                        time_window=[0, self.time_limit],
-                        capacity=list(self.capacities.values())
-                        )
-            for i in range(self.num_vehicles)
-            ]
-        df = pd.read_excel(BENEFICIARIES_XLSX)
-        jobs = [opt.Job(id=i, **self.job_from_row(row)) for i, row in df.iterrows() ]
+        vehicles = self.vehicles()
+        table = self.table
+        if len(table.errors) > 0:
+            table.print_errors()
+            return
+        jobs = [{'id': i, **self.job_from_row(i)} for i in range(len(table))]
         
+        keys = table.keys()
+        with self.metrics.stage('solve'):
+            return self.solve(jobs, keys, vehicles, clusters, incremental, force)
+    
+    
+    def solve(self, jobs, keys, vehicles, clusters=None, incremental=False, force=False):
+        """Delivery plan for `jobs`, saved as the last plan."""
+        optimized = None
+        cache_key = None
+        if not incremental:
+            cache_key = self.plan_cache.key(jobs, vehicles, self.plan_options(clusters))
+            if not force:
+                optimized = self.plan_cache.get(cache_key)
+            if optimized is not None:
+                print(green('The roster and fleet are unchanged. Using the cached plan.'))
+                cache_key = None
+        if incremental and os.path.exists(LAST_PLAN_JSON):
+            with open(LAST_PLAN_JSON) as f:
+                last = json.load(f)
+            optimized = reoptimize(last, jobs, keys, vehicles, self.get_matrix(),
+                                   self.get_solver())
+            if optimized is None:
+                print(yellow('The beneficiaries changed too much since the last plan. '
+                             'Solving from scratch.'))
+            else:
+                print(green('Updated the last plan with the changed beneficiaries.'))
+        if optimized is None and clusters is None:
+            optimized = self.coalesced(jobs, vehicles, self.get_solver())
+        elif optimized is None:
+            solver = self.get_solver()
+            optimized = self.coalesced(jobs, vehicles, solver,
+                                       lambda jobs: solve_clustered(solver, jobs,
+                                                                    vehicles, clusters,
+                                                                    matrix=self.get_matrix()))
+        if cache_key is not None:
+            self.plan_cache.put(cache_key, optimized)
+        save_plan(optimized, jobs, keys, vehicles)
+        return optimized
+    
+    
+    def plan_options(self, clusters=None):
+        """Everything besides jobs and vehicles that a solved plan depends on."""
+        solver = self.solver if isinstance(self.solver, str) else type(self.solver).__name__
+        matrix = self.matrix
+        if isinstance(matrix, MatrixService):
+            matrix = 'ors'
+        elif matrix is not None and not isinstance(matrix, str):
+            matrix = getattr(matrix, '__name__', type(matrix).__name__)
+        return {'solver': solver,
+                'matrix': matrix,
+                'clusters': clusters,
+                'coalesce_radius': self.coalesce_radius,
+                'coalesce_service_scale': self.coalesce_service_scale}
+    
+    
+    def sweep(self, scenarios, workers=SWEEP_WORKERS):
+        """Solve every scenario concurrently, without geometry or maps, and
+        compare them in one table row each. A scenario is a dict overriding
+        any of number_of_vehicles, time_limit, stop_time and capacities. All
+        scenarios share the parsed roster and one travel time lookup."""
         if not self.valid:
             return
-        optimized = client.optimization(jobs=jobs, vehicles=vehicles, geometry=True)
+        table = self.table
+        if len(table.errors) > 0:
+            table.print_errors()
+            return
+        return self.solve_scenarios(self.scenario_solver(), scenarios, workers)
+    
+    
+    def min_feasible(self,
+                     param='number_of_vehicles',
+                     lo=1,
+                     hi=None,
+                     step=1,
+                     workers=SWEEP_WORKERS,
+                     **scenario):
+        """Smallest value of `param` (number_of_vehicles or time_limit, on a
+        grid of `step` from `lo`) whose plan serves every beneficiary, with
+        the other settings from `scenario`. Each round probes `workers`
+        values concurrently and narrows the range between the largest
+        infeasible and the smallest feasible value; more vehicles or time
+        are assumed never to hurt, which heuristic solvers only follow
+        approximately. `hi` defaults to one vehicle per beneficiary or the
+        configured value. Other parameters raise ValueError.
+
+        Returns the value, or None if `hi` is infeasible, and the table of
+        every probed scenario."""
+        if param not in MIN_FEASIBLE_PARAMS:
+            raise ValueError(f'Cannot search {param!r}; '
+                             f'expected one of {", ".join(MIN_FEASIBLE_PARAMS)}.')
+        if not self.valid:
+            return None, None
+        table = self.table
+        if len(table.errors) > 0:
+            table.print_errors()
+            return None, None
+        if hi is None:
+            hi = len(table) if param == 'number_of_vehicles' else getattr(self, param)
+        hi = lo + int(np.ceil((hi - lo) / step)) * step
+        solver = self.scenario_solver()
+        rows = {}
         
+        def probe(values):
+            results = self.solve_scenarios(solver, [{**scenario, param: v} for v in values],
+                                           workers)
+            rows.update(zip(values, results.to_dict('records')))
+        
+        probe([hi])
+        if not rows[hi]['feasible']:
+            return None, pd.DataFrame(rows.values())
+        while lo < hi:
+            num_steps = (hi - lo) // step
+            offsets = np.unique(num_steps * np.arange(1, workers + 1) // (workers + 1))
+            candidates = [lo + int(k) * step for k in offsets if lo + int(k) * step not in rows]
+            probe(candidates)
+            hi = min([v for v in candidates if rows[v]['feasible']] + [hi])
+            lo = max([v + step for v in candidates if not rows[v]['feasible'] and v < hi]
+                     + [lo])
+        print(f'Minimum feasible {param}: {green(hi)}')
+        return hi, pd.DataFrame(rows.values()).sort_values(param, ignore_index=True)
+    
+    
+    def scenario_solver(self):
+        """Solver for repeated scenario solves. The local solver looks travel
+        times up once for every beneficiary and the vehicle start."""
+        if self.solver != 'local':
+            return self.get_solver()
+        table = self.table
+        locations = [[float(lon), float(lat)] for lon, lat in zip(table.lon, table.lat)] + \
+                    [list(reversed(self.vehicle_start['location']))]
+        return LocalSolver(matrix=precomputed_matrix(self.get_matrix(), locations))
+    
+    
+    def solve_scenarios(self, solver, scenarios, workers=SWEEP_WORKERS):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return pd.DataFrame(executor.map(lambda s: self.solve_scenario(solver, s),
+                                             scenarios))
+    
+    
+    def solve_scenario(self, solver, scenario):
+        """Comparison table row of one scenario."""
+        stop_time = scenario.get('stop_time', self.stop_time)
+        time_limit = scenario.get('time_limit', self.time_limit)
+        capacities = {**self.capacities, **scenario.get('capacities', {})}
+        vehicles = self.vehicles(scenario.get('number_of_vehicles'), time_limit, capacities)
+        jobs = [{'id': i, **self.job_from_row(i, stop_time)} for i in range(len(self.table))]
+        with self.metrics.stage('solve'):
+            plan = self.coalesced(jobs, vehicles, solver, quiet=True)
+        durations = [route['duration'] + route['service'] for route in plan['routes']]
+        return {
+            'number_of_vehicles': len(vehicles),
+            'time_limit': time_limit,
+            'stop_time': stop_time,
+            **{f'capacity {meal}': capacities[meal] for meal in self.meal_options},
+            'vehicles_used': len(plan['routes']),
+            'unassigned': len(plan['unassigned']),
+            'feasible': len(plan['unassigned']) == 0,
+            'total_duration': sum(durations),
+            'longest_route': max(durations, default=0),
+        }
+    
+    
+    def coalesced(self, jobs, vehicles, solver, solve=None, quiet=False):
+        """Plan from `solve`, by default `solver` on all `vehicles`, run on
+        `jobs` with co-located beneficiaries merged into one stop (see
+        colocated_groups), expanded back to one step each. Members of merged
+        stops left unassigned are then offered to the vehicles one by one,
+        since a whole group may not fit where some of its members would.
+        Opt in by setting `coalesce_radius`, e.g. to COALESCE_RADIUS meters."""
+        if solve is None:
+            solve = lambda jobs: solver.solve(jobs, vehicles)
+        if self.coalesce_radius is None:
+            return solve(jobs)
+        table = self.table
+        groups = colocated_groups(table.lat, table.lon, table.gaddrs, self.coalesce_radius)
+        capacity = np.max([vehicle['capacity'] for vehicle in vehicles], axis=0)
+        groups = [part for group in groups for part in split_group(group, jobs, capacity)]
+        if len(groups) == len(jobs):
+            return solve(jobs)
+        if not quiet:
+            print(f'Merged {green(len(jobs))} beneficiaries into {green(len(groups))} stops.')
+        merged = merge_jobs(jobs, groups, self.coalesce_service_scale)
+        plan = expand_plan(solve(merged), jobs, groups)
+        matrix = solver.matrix if isinstance(solver, LocalSolver) else self.get_matrix()
+        return rebalance_plan(plan, solver, jobs, vehicles, matrix)
+    
+    
+    def uses_ors(self):
+        return self.solver == 'ors' or self.matrix == 'ors' or \
+            isinstance(self.matrix, MatrixService)
+    
+    
+    def route_geometries(self, routes, profile='driving-car'):
+        """Encoded polyline of every route, in order. Plans are solved without
+        geometry; road geometries are fetched from the ORS directions
+        endpoint concurrently and cached by stop sequence in their own
+        cache, apart from the geocoding responses, so unchanged routes are
+        never fetched again. Without ORS, stops are joined by straight
+        lines."""
+        geometries = [route.get('geometry') for route in routes]
+        if not self.uses_ors():
+            return [geometry if geometry is not None else
+                    encode_polyline([step['location'] for step in route['steps']])
+                    for geometry, route in zip(geometries, routes)]
+        if self.geometry_cache is None:
+            self.geometry_cache = GeocodeCache(GEOMETRY_CACHE_DB, ttl=None,
+                                               max_entries=GEOMETRY_CACHE_SIZE)
+        pending = {}
+        for i, route in enumerate(routes):
+            if geometries[i] is not None:
+                continue
+            locations = [[round(float(lon), PRECISION), round(float(lat), PRECISION)]
+                         for lon, lat in (step['location'] for step in route['steps'])]
+            key = hashlib.sha1(json.dumps([profile, locations]).encode()).hexdigest()
+            cached = self.geometry_cache.get('ors_directions', key)
+            if cached is not None:
+                geometries[i] = cached['geometry']
+            else:
+                pending[i] = key, locations
+        if len(pending) > 0:
+            client = self.ors_client()
+            with ThreadPoolExecutor(max_workers=GEOMETRY_WORKERS) as executor:
+                fetched = executor.map(
+                    lambda item: fetch_route_geometry(client, item[1], profile, self.metrics),
+                    pending.values())
+                for i, (key, _), geometry in zip(pending, pending.values(), fetched):
+                    self.geometry_cache.put('ors_directions', key, {'geometry': geometry})
+                    geometries[i] = geometry
+        return geometries
+    
+    
+    def export(self, plan=None, path=EXPORT_DIR, overview=True, workers=EXPORT_WORKERS):
+        """Write a lightweight map (vehicle_N.html), a printable manifest
+        (vehicle_N.txt) and a stop list (vehicle_N.csv) for every vehicle of
+        `plan` to the directory `path`, concurrently, plus unassigned.csv if
+        any beneficiary is unserved. With `overview`, overview.html shows
+        every route with simplified lines only. `plan` defaults to the plan
+        for the current roster and fleet. Returns the written paths."""
+        plan = plan if plan is not None else self.get_plan()
+        if plan is None:
+            return
+        with self.metrics.stage('export'):
+            os.makedirs(path, exist_ok=True)
+            routes = plan['routes']
+            geometries = self.route_geometries(routes)
+            colors = rainbow(self.num_vehicles)
+            stops = self.route_stops(routes)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(self.export_vehicle, path, i, route, stops[i],
+                                           geometries[i], colors[i])
+                           for i, route in enumerate(routes)]
+                if overview:
+                    futures.append(executor.submit(self.export_overview, path, geometries,
+                                                   colors))
+                written = [file for future in futures for file in future.result()]
+            if len(plan['unassigned']) > 0:
+                table = self.table
+                file = os.path.join(path, 'unassigned.csv')
+                pd.DataFrame({'Name': [cell_text(table.names[una['id']])
+                                       for una in plan['unassigned']],
+                              'Address': [cell_text(table.addresses[una['id']])
+                                          for una in plan['unassigned']]}
+                             ).to_csv(file, index=False)
+                written.append(file)
+        print(f'Wrote {green(len(written))} files for {len(routes)} vehicles to {green(path)}.')
+        return written
+    
+    
+    def route_stops(self, routes):
+        """Beneficiary table row, arrival and load after each delivery of
+        every route."""
+        location_index = None
+        stops = []
+        for route in routes:
+            stops.append([])
+            for step in route['steps']:
+                if not step['type'] == 'job':
+                    continue
+                job_id = step_job_id(step)
+                if job_id is None:
+                    if location_index is None:
+                        location_index = LocationIndex(self.table.lat, self.table.lon,
+                                                       range(len(self.table)))
+                    job_id = location_index.pop(round(float(step['location'][1]), PRECISION),
+                                                round(float(step['location'][0]), PRECISION))
+                stops[-1].append((job_id, int(step['arrival']), step['load']))
+        return stops
+    
+    
+    def export_vehicle(self, path, i, route, stops, geometry, color):
+        import folium
+        from folium.plugins import FastMarkerCluster
+        
+        table = self.table
+        name = f'vehicle_{i+1}'
+        m = folium.Map(**DEFAULT_MAP)
+        set_popup_background(m)
+        set_popup_style(m)
+        self.start_marker().add_to(m)
+        line = simplify_polyline(decode_polyline(geometry),
+                                 zoom_tolerance(DETAIL_ZOOM, DEFAULT_MAP['location'][0]))
+        folium.PolyLine(locations=line.tolist(), color=color, opacity=0.7).add_to(m)
+        FastMarkerCluster([[float(table.lat[j]), float(table.lon[j]), i+1,
+                            cell_text(table.names[j]), cell_text(table.addresses[j]),
+                            [int(x) for x in table.meals[j]], hrs_mins_from_secs(arrival),
+                            [int(x) for x in load], color]
+                           for j, arrival, load in stops],
+                          callback=STOP_CALLBACK % json.dumps(list(self.meal_options)),
+                          options={'disableClusteringAtZoom': 14}).add_to(m)
+        if len(stops) > 0:
+            m.fit_bounds([[float(table.lat[j]), float(table.lon[j])] for j, _, _ in stops])
+        html = os.path.join(path, f'{name}.html')
+        m.save(html)
+        
+        lines = [f'Vehicle {i+1}',
+                 f'Total duration: {hrs_mins_from_secs(route["duration"] + route["service"])}',
+                 f'Number of Deliveries: {len(stops)}',
+                 'Meals to Deliver:']
+        lines += [f'  {mo}: {num_meal}' for mo, num_meal in zip(self.meal_options, route['amount'])]
+        lines.append('')
+        for ndel, (j, arrival, load) in enumerate(stops):
+            lines.append(f'[ ] Delivery {ndel+1}: {cell_text(table.names[j])}')
+            lines.append(f'    {cell_text(table.addresses[j])}')
+            if cell_text(table.remarks[j]):
+                lines.append(f'    {cell_text(table.remarks[j])}')
+            lines.append(f'    Arrive in {hrs_mins_from_secs(arrival)}')
+            lines += [f'    {mo}: {num_meal}'
+                      for mo, num_meal in zip(self.meal_options, table.meals[j]) if num_meal > 0]
+            lines.append('')
+        manifest = os.path.join(path, f'{name}.txt')
+        with open(manifest, 'w') as f:
+            f.write('\n'.join(lines))
+        
+        csv = os.path.join(path, f'{name}.csv')
+        pd.DataFrame([{'Stop': ndel + 1,
+                       'Beneficiary Name': cell_text(table.names[j]),
+                       'Address': cell_text(table.addresses[j]),
+                       'Remarks': cell_text(table.remarks[j]),
+                       'Arrival': hrs_mins_from_secs(arrival).strip(),
+                       'Arrival (s)': arrival,
+                       **{mo: int(num_meal) for mo, num_meal in zip(self.meal_options,
+                                                                    table.meals[j])},
+                       'Lattitude': float(table.lat[j]),
+                       'Longitude': float(table.lon[j])}
+                      for ndel, (j, arrival, load) in enumerate(stops)]).to_csv(csv, index=False)
+        return [html, manifest, csv]
+    
+    
+    def export_overview(self, path, geometries, colors):
+        import folium
+        
+        m = folium.Map(**DEFAULT_MAP)
+        set_popup_background(m)
+        self.start_marker().add_to(m)
+        tolerance = zoom_tolerance(DEFAULT_MAP['zoom_start'], DEFAULT_MAP['location'][0], pixels=2)
+        for i, geometry in enumerate(geometries):
+            folium.PolyLine(locations=simplify_polyline(decode_polyline(geometry),
+                                                        tolerance).tolist(),
+                            color=colors[i],
+                            opacity=0.7,
+                            tooltip=f'Vehicle {i+1}').add_to(m)
+        file = os.path.join(path, 'overview.html')
+        m.save(file)
+        return [file]
+    
+    
+    def render_plan(self, optimized, compact=False, simplify=False):
+        """Print the itinerary of every vehicle and draw the plan on a map.
+        With `compact`, stops and unserved beneficiaries are emitted as marker
+        layers whose popups are built in the browser."""
+        import folium
+        from folium.plugins import FastMarkerCluster
+        
+        table = self.table
         m = folium.Map(**DEFAULT_MAP)
         set_popup_background(m)
+        if compact:
+            set_popup_style(m)
+        self.start_marker().add_to(m)
         
         if len(optimized['unassigned']) > 0:
             print(red(f'Insufficient time or vehicles. '
                       f'{len(optimized["unassigned"])} unserved beneficiaries.'))
+        unserved = []
         for una in optimized['unassigned']:
-            row = df.loc[una['id']]
-            name = row[self.nam_c]
-            addr = row[self.adr_c]
-            lat = row[self.lat_c]
-            lon = row[self.lon_c]
+            name = table.names[una['id']]
+            addr = table.addresses[una['id']]
+            lat = table.lat[una['id']]
+            lon = table.lon[una['id']]
             print(f'{name} at {addr}')
             
+            if compact:
+                unserved.append([float(lat), float(lon), cell_text(name), cell_text(addr)])
+                continue
             iframe = folium.IFrame(f'{STYLE}'
                                    f'<h3>{name}</h3>{addr}',
                                    width=WIDTH,
@@ -362,16 +1146,24 @@ class Util:
                             icon=folium.Icon(color='red',
                                              icon='remove')).add_to(m)
             
+        if len(unserved) > 0:
+            FastMarkerCluster(unserved, callback=UNASSIGNED_CALLBACK,
+                              options={'disableClusteringAtZoom': 14}).add_to(m)
         if len(optimized['unassigned']) > 0:
             print('\n')
         
+        location_index = None
+        stops = []
         colors = rainbow(self.num_vehicles)
+        geometries = self.route_geometries(optimized['routes'])
         for i,route in enumerate(optimized['routes']):
-            folium.PolyLine(locations=[
-                list(reversed(coord)) for coord in
-                ors.convert.decode_polyline(route['geometry'])['coordinates']],
-                color=colors[i],
-                opacity=0.5).add_to(m)
+            line = decode_polyline(geometries[i])
+            if simplify:
+                line = simplify_polyline(line, zoom_tolerance(DEFAULT_MAP['zoom_start'],
+                                                              DEFAULT_MAP['location'][0]))
+            folium.PolyLine(locations=line.tolist(),
+                            color=colors[i],
+                            opacity=0.5).add_to(m)
             
             print(blue(f'Vehicle {i+1}'))
             print(f'Total duration: '
@@ -395,11 +1187,15 @@ class Util:
                 lon = round(float(step['location'][0]),PRECISION)
                 lat = round(float(step['location'][1]),PRECISION)
                 arrival = int(step['arrival'])
-                mask = aeq(df.iloc[:,self.lat_c],lat) & \
-                       aeq(df.iloc[:,self.lon_c],lon)
-                row = df.loc[mask].iloc[0]
-                name = row[self.nam_c]
-                addr = row[self.adr_c]
+                job_id = step_job_id(step)
+                if job_id is None:
+                    # Legacy responses without job ids: resolve by coordinates.
+                    if location_index is None:
+                        location_index = LocationIndex(table.lat, table.lon,
+                                                       range(len(table)))
+                    job_id = location_index.pop(lat, lon)
+                name = table.names[job_id]
+                addr = table.addresses[job_id]
                 load = step['load']
                 time = hrs_mins_from_secs(arrival)
                 
@@ -409,8 +1205,7 @@ class Util:
                 
                 meals = ''
                 carry = ''
-                for mo,mc,lo in zip(self.meal_options, self.meal_options_c, load):
-                    num_meal = int(row[mc])
+                for mo,num_meal,lo in zip(self.meal_options, table.meals[job_id], load):
                     meals += f'{mo}: {num_meal}<br/>'
                     carry += f'{mo}: {lo}<br/>'
                     
@@ -418,6 +1213,11 @@ class Util:
                         print(f'    {mo}: {num_meal}')
                 print('')
                 
+                if compact:
+                    stops.append([lat, lon, i+1, cell_text(name), cell_text(addr),
+                                  [int(x) for x in table.meals[job_id]], time,
+                                  [int(x) for x in load], colors[i]])
+                    continue
                 iframe = folium.IFrame(f'{STYLE}'
                                        f'<h2>Vehicle {i+1}</h2>'
                                        f'<h3>{name}</h3>{addr}'
@@ -433,21 +1233,1163 @@ class Util:
                               icon=folium.Icon(color='black',
                                                icon='map-marker',
                                                icon_color=colors[i])).add_to(m)
-                s_iframe = folium.IFrame(f'{STYLE}'
-                                         f'<h3>Vehicle Start</h3>{self.vehicle_start["name"]}<br/>'
-                                         f'{self.vehicle_start["location"][0]} °N, '
-                                         f'{self.vehicle_start["location"][1]} °E',
-                                         width=300,
-                                         height=100)
-                folium.Marker(location=self.vehicle_start['location'],
-                              popup=folium.Popup(s_iframe, max_width=1000),
-                              icon=folium.Icon(color='black',
-                                               icon='home')).add_to(m)
                 
             print('\n')
+        if compact:
+            FastMarkerCluster(stops,
+                              callback=STOP_CALLBACK % json.dumps(list(self.meal_options)),
+                              options={'disableClusteringAtZoom': 14}).add_to(m)
         return m
 
 
+class BeneficiaryTable:
+    """The beneficiaries sheet parsed once into typed column arrays.
+
+    Coordinates and meal counts are validated in a single vectorized pass.
+    Cells that fail to parse are listed in `errors`, and the rows they belong
+    to are excluded from the `valid` mask."""
+
+    def __init__(self, df, nam_c, adr_c, rmk_c, lat_c, lon_c, gname_c, gaddr_c,
+                 meal_options, meal_options_c):
+        self.meal_options = list(meal_options)
+        self.names = df.iloc[:, nam_c].to_numpy(dtype=object)
+        self.addresses = df.iloc[:, adr_c].to_numpy(dtype=object)
+        self.remarks = df.iloc[:, rmk_c].to_numpy(dtype=object)
+        self.gnames = df.iloc[:, gname_c].to_numpy(dtype=object)
+        self.gaddrs = df.iloc[:, gaddr_c].to_numpy(dtype=object)
+
+        raw_lat = df.iloc[:, lat_c]
+        raw_lon = df.iloc[:, lon_c]
+        raw_meals = df.iloc[:, list(meal_options_c)]
+        self.lat = np.round(pd.to_numeric(raw_lat, errors='coerce').to_numpy(dtype=float),
+                            PRECISION)
+        self.lon = np.round(pd.to_numeric(raw_lon, errors='coerce').to_numpy(dtype=float),
+                            PRECISION)
+        meals = raw_meals.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+        bad_meals = ~np.isfinite(meals) | (meals != np.round(meals))
+        self.meals = np.where(bad_meals, 0, meals).astype(int)
+
+        bad_lat = np.isnan(self.lat) & raw_lat.notna().to_numpy()
+        bad_lon = np.isnan(self.lon) & raw_lon.notna().to_numpy()
+        missing = (np.isnan(self.lat) | np.isnan(self.lon)) & ~(bad_lat | bad_lon)
+        self.valid = ~(bad_lat | bad_lon | missing | bad_meals.any(axis=1))
+
+        checks = [('lattitude', bad_lat, raw_lat),
+                  ('longitude', bad_lon, raw_lon),
+                  ('coordinates', missing, None)]
+        checks += [(mo, bad_meals[:, j], raw_meals.iloc[:, j])
+                   for j, mo in enumerate(self.meal_options)]
+        self.errors = []
+        for field, bad, raw in checks:
+            for i in np.flatnonzero(bad):
+                self.errors.append({
+                    'row': int(i),
+                    'name': self.names[i],
+                    'field': field,
+                    'value': None if raw is None else raw.iloc[i],
+                })
+        self.errors.sort(key=lambda err: err['row'])
+
+
+    @classmethod
+    def from_columns(cls, df, util):
+        return cls(df, util.nam_c, util.adr_c, util.rmk_c, util.lat_c, util.lon_c,
+                   util.gname_c, util.gaddr_c, util.meal_options, util.meal_options_c)
+
+
+    def __len__(self):
+        return len(self.names)
+
+
+    def keys(self):
+        """Identity of each beneficiary that is stable across sheet edits."""
+        seen = {}
+        keys = []
+        for name, addr in zip(self.names, self.addresses):
+            key = f'{str(name).strip().lower()}|{normalize_address(addr)}'
+            seen[key] = seen.get(key, 0) + 1
+            keys.append(key if seen[key] == 1 else f'{key}#{seen[key]}')
+        return keys
+
+
+    def print_errors(self):
+        for err in self.errors:
+            name = err['name']
+            if err['field'] == 'coordinates':
+                print(f'{red("ERROR:")} {name}\'s address has no coordinates. '
+                      'Please run update_coords or input them manually.')
+            elif err['field'] in ('lattitude', 'longitude'):
+                print(f'{red("ERROR:")} The {err["field"]} of {name}\'s address '
+                      f'has a formatting error. [{red(err["value"])}]')
+            else:
+                print(f'{red("ERROR:")} The number of {err["field"]}s for {name}'
+                      ' has a formatting error. '
+                      f'[{red(err["value"])}]')
+
+
+def step_job_id(step):
+    """Id of the job served at an optimization step, if the response has one."""
+    if 'id' in step:
+        return step['id']
+    return step.get('job')
+
+
+class LocationIndex:
+    """Spatial hash from rounded coordinates to row labels. Each lookup hands
+    out the next unclaimed row at that location, so co-located beneficiaries
+    resolve to distinct rows."""
+
+    def __init__(self, lats, lons, labels=None):
+        labels = lats.index if labels is None else labels
+        self.buckets = {}
+        for label, lat, lon in zip(labels, lats, lons):
+            try:
+                key = self.key(lat, lon)
+            except (TypeError, ValueError):
+                continue
+            self.buckets.setdefault(key, []).append(label)
+
+
+    @staticmethod
+    def key(lat, lon):
+        return (int(round(float(lat) * 10**PRECISION)),
+                int(round(float(lon) * 10**PRECISION)))
+
+
+    def pop(self, lat, lon):
+        key = self.key(lat, lon)
+        for dlat in (0, -1, 1):
+            for dlon in (0, -1, 1):
+                bucket = self.buckets.get((key[0]+dlat, key[1]+dlon))
+                if bucket:
+                    return bucket.pop(0)
+        raise KeyError(f'No beneficiary found at {lat} °N, {lon} °E.')
+
+
+class ORSSolver:
+    """Solver backend using the openrouteservice optimization endpoint."""
+
+    def __init__(self, client, metrics=None):
+        self.client = client
+        self.metrics = metrics if metrics is not None else Metrics()
+
+
+    def solve(self, jobs, vehicles, geometry=False):
+        from openrouteservice import optimization as opt
+        with self.metrics.call('ors_optimization'):
+            return self.client.optimization(jobs=[opt.Job(**job) for job in jobs],
+                                            vehicles=[opt.Vehicle(**v) for v in vehicles],
+                                            geometry=geometry)
+
+
+class LocalSolver:
+    """Offline solver backend. Builds routes one vehicle at a time from jobs
+    swept by angle around the start, improves them with 2-opt, Or-opt and
+    inter-route relocate moves over a travel duration matrix, then ruins and
+    recreates neighbourhoods of jobs by regret insertion, placing unassigned
+    jobs where it can. The search runs for up to `search_time` seconds, or
+    until LOCAL_SEARCH_STALL rounds in a row bring no improvement.
+
+    `matrix` maps a list of [lon, lat] locations to (durations, distances)
+    arrays and defaults to straight-line estimates. Responses follow the
+    shape of the openrouteservice optimization endpoint."""
+
+    def __init__(self, matrix=None, search_time=LOCAL_SEARCH_TIME, seed=0):
+        self.matrix = matrix if matrix is not None else haversine_matrix
+        self.search_time = search_time
+        self.seed = seed
+
+
+    def solve(self, jobs, vehicles, geometry=False):
+        deadline = time.monotonic() + self.search_time
+        locations = [job['location'] for job in jobs] + \
+                    [v['start'] for v in vehicles] + \
+                    [v['end'] for v in vehicles]
+        durations, distances = self.matrix(locations)
+        instance = VRPInstance(jobs, vehicles, durations)
+        routes, unassigned = instance.sweep()
+        unassigned = instance.improve(routes, unassigned, deadline)
+        routes, unassigned = instance.search(routes, unassigned, deadline,
+                                             random.Random(self.seed))
+        return instance.result(routes, unassigned, distances, geometry)
+
+
+class VRPInstance:
+    """Jobs, vehicles and travel durations of a capacitated VRP, indexed for
+    vectorized move evaluation. Job j is node j; vehicle v starts at node
+    n+v and ends at node n+V+v. Routes are lists of job nodes."""
+
+    def __init__(self, jobs, vehicles, durations):
+        self.jobs = jobs
+        self.vehicles = vehicles
+        self.n = len(jobs)
+        self.nv = len(vehicles)
+        self.D = np.asarray(durations, dtype=float)
+        self.dims = max([len(v.get('capacity', [])) for v in vehicles] +
+                        [len(job.get('amount', [])) for job in jobs] + [0])
+        self.amount = np.zeros((self.n, self.dims))
+        for j, job in enumerate(jobs):
+            amount = job.get('amount', [])
+            self.amount[j, :len(amount)] = amount
+        self.capacity = np.full((self.nv, self.dims), np.inf)
+        for v, vehicle in enumerate(vehicles):
+            capacity = vehicle.get('capacity', [])
+            self.capacity[v, :len(capacity)] = capacity
+        self.service = np.array([job.get('service', 0) for job in jobs], dtype=float)
+        windows = np.array([v.get('time_window', [0, np.inf]) for v in vehicles],
+                           dtype=float).reshape(self.nv, 2)
+        self.ready = windows[:, 0]
+        self.limit = windows[:, 1] - windows[:, 0]
+
+
+    def nodes(self, v, seq):
+        return [self.n + v] + list(seq) + [self.n + self.nv + v]
+
+
+    def travel(self, v, seq):
+        nodes = self.nodes(v, seq)
+        return self.D[nodes[:-1], nodes[1:]].sum()
+
+
+    def route_time(self, v, seq):
+        return self.travel(v, seq) + self.service[list(seq)].sum()
+
+
+    def load(self, seq):
+        return self.amount[list(seq)].sum(axis=0)
+
+
+    def sweep(self):
+        """Routes filled one vehicle at a time by cheapest insertion of jobs in
+        angular order around the first vehicle's start, so each vehicle
+        serves a compact sector. Returns the routes and the jobs left over."""
+        routes = [[] for _ in self.vehicles]
+        if self.n == 0:
+            return routes, []
+        order = sweep_clusters(self.jobs, self.vehicles[0]['start'], np.ones(self.n), 1)[0]
+        left = []
+        v = 0
+        for j in order:
+            j = int(j)
+            while v < self.nv and self.insert([routes[v]], [j], [v]):
+                if len(routes[v]) == 0:
+                    break
+                v += 1
+            if v == self.nv or j not in routes[v]:
+                left.append(j)
+        return routes, left
+
+
+    def insert(self, routes, pending, vehicles=None):
+        """Cheapest feasible insertion of `pending` jobs, in order, into
+        `routes` of `vehicles` (all by default). Returns the jobs that fit
+        nowhere."""
+        vehicles = np.arange(self.nv) if vehicles is None else np.asarray(vehicles)
+        loads = np.array([self.load(seq) for seq in routes]).reshape(len(routes), self.dims)
+        times = np.array([self.route_time(v, seq) for v, seq in zip(vehicles, routes)])
+        left = []
+        for j in pending:
+            best, best_v, best_k = np.inf, None, None
+            fits = np.all(loads + self.amount[j] <= self.capacity[vehicles], axis=1)
+            for r in np.flatnonzero(fits):
+                v = vehicles[r]
+                nodes = self.nodes(v, routes[r])
+                a, b = nodes[:-1], nodes[1:]
+                delta = self.D[a, j] + self.D[j, b] - self.D[a, b]
+                k = np.argmin(delta)
+                if delta[k] < best and times[r] + delta[k] + self.service[j] <= self.limit[v]:
+                    best, best_v, best_k = delta[k], r, k
+            if best_v is None:
+                left.append(j)
+                continue
+            routes[best_v].insert(best_k, j)
+            loads[best_v] += self.amount[j]
+            times[best_v] += best + self.service[j]
+        return left
+
+
+    def improve(self, routes, unassigned, deadline):
+        """Local search until no move improves or `deadline` passes. Jobs that
+        become insertable along the way are taken out of `unassigned`."""
+        while time.monotonic() < deadline:
+            for v in range(self.nv):
+                routes[v] = self.or_opt(v, self.two_opt(v, routes[v], deadline), deadline)
+            moved = self.relocate(routes)
+            if len(unassigned) > 0:
+                unassigned = self.insert(routes, unassigned)
+            if not moved:
+                break
+        return unassigned
+
+
+    def search(self, routes, unassigned, deadline, rng):
+        """Ruin and recreate: repeatedly take out a neighbourhood of related
+        jobs, assigned or not, and put them back by regret insertion. Trials
+        serving more jobs, or as many in less time, replace the solution."""
+        unassigned = list(unassigned)
+        if self.n < 2:
+            return routes, unassigned
+        times = np.array([self.route_time(v, seq) for v, seq in enumerate(routes)])
+        best = routes, unassigned, times
+        stall = 0
+        while time.monotonic() < deadline and stall < LOCAL_SEARCH_STALL:
+            stall += 1
+            trial = [list(seq) for seq in routes]
+            removed = self.ruin(trial, unassigned, rng)
+            left = self.recreate(trial, removed)
+            touched = [v for v in range(self.nv) if trial[v] != routes[v]]
+            for v in touched:
+                trial[v] = self.or_opt(v, self.two_opt(v, trial[v], deadline), deadline)
+            trial_times = times.copy()
+            trial_times[touched] = [self.route_time(v, trial[v]) for v in touched]
+            trial_unassigned = [j for j in unassigned if j not in removed] + left
+            # Record-to-record travel: also take trials slightly worse than
+            # the best solution, to move between local optima.
+            if (len(trial_unassigned), trial_times.sum()) <= \
+                    (len(best[1]), best[2].sum() * (1 + LOCAL_SEARCH_SLACK)):
+                routes, unassigned, times = trial, trial_unassigned, trial_times
+            if (len(unassigned), times.sum()) < (len(best[1]), best[2].sum() - EPS):
+                best = routes, unassigned, times
+                stall = 0
+        return best[0], best[1]
+
+
+    def ruin(self, routes, unassigned, rng):
+        """Take the jobs closest to a random one, half the time an unassigned
+        one, out of `routes`. Returns every job of the neighbourhood."""
+        if len(unassigned) > 0 and rng.random() < 0.5:
+            seed = rng.choice(unassigned)
+        else:
+            seed = rng.randrange(self.n)
+        size = min(self.n, rng.randint(*LOCAL_RUIN_SIZE))
+        closeness = self.D[seed, :self.n] + self.D[:self.n, seed]
+        removed = set(int(j) for j in np.argsort(closeness, kind='stable')[:size])
+        for v, seq in enumerate(routes):
+            routes[v] = [j for j in seq if j not in removed]
+        return removed
+
+
+    def insertion(self, v, seq, pending, load, route_time):
+        """Cheapest feasible insertion cost and position of every `pending`
+        job into route `v`, inf where the job does not fit."""
+        nodes = np.array(self.nodes(v, seq))
+        a, b = nodes[:-1], nodes[1:]
+        delta = self.D[a[None, :], pending[:, None]] + self.D[pending[:, None], b[None, :]] - \
+                self.D[a, b][None, :]
+        pos = np.argmin(delta, axis=1)
+        cost = delta[np.arange(len(pending)), pos]
+        fits = np.all(load + self.amount[pending] <= self.capacity[v], axis=1) & \
+               (route_time + cost + self.service[pending] <= self.limit[v])
+        return np.where(fits, cost, np.inf), pos
+
+
+    def recreate(self, routes, pending):
+        """Regret insertion of `pending` jobs into `routes`: the job losing
+        most by not getting its best vehicle goes first. Returns the jobs
+        that fit nowhere."""
+        pending = np.array(sorted(pending), dtype=int)
+        loads = np.array([self.load(seq) for seq in routes]).reshape(self.nv, self.dims)
+        times = np.array([self.route_time(v, seq) for v, seq in enumerate(routes)])
+        cost = np.empty((len(pending), self.nv))
+        pos = np.empty((len(pending), self.nv), dtype=int)
+        for v in range(self.nv):
+            cost[:, v], pos[:, v] = self.insertion(v, routes[v], pending, loads[v], times[v])
+        while len(pending) > 0:
+            ranked = np.sort(cost, axis=1)
+            best = ranked[:, 0]
+            if not np.isfinite(best).any():
+                break
+            with np.errstate(invalid='ignore'):
+                regret = ranked[:, 1] - best if self.nv > 1 else -best
+            regret = np.where(np.isfinite(best), regret, -np.inf)
+            i = np.lexsort((best, -regret))[0]
+            j, v = pending[i], int(np.argmin(cost[i]))
+            routes[v].insert(pos[i, v], int(j))
+            loads[v] += self.amount[j]
+            times[v] += best[i] + self.service[j]
+            pending = np.delete(pending, i)
+            cost = np.delete(cost, i, axis=0)
+            pos = np.delete(pos, i, axis=0)
+            cost[:, v], pos[:, v] = self.insertion(v, routes[v], pending, loads[v], times[v])
+        return [int(j) for j in pending]
+
+
+    def two_opt(self, v, seq, deadline):
+        while len(seq) >= 3 and time.monotonic() < deadline:
+            nodes = np.array(self.nodes(v, seq))
+            fwd = np.concatenate([[0], np.cumsum(self.D[nodes[:-1], nodes[1:]])])
+            bwd = np.concatenate([[0], np.cumsum(self.D[nodes[1:], nodes[:-1]])])
+            # Reverse nodes[i+1..j], replacing edges (a,b) and (c,d) by (a,c) and (b,d).
+            i, j = np.triu_indices(len(nodes) - 1, k=1)
+            a, b, c, d = nodes[i], nodes[i+1], nodes[j], nodes[j+1]
+            gain = (self.D[a, b] + self.D[c, d] + fwd[j] - fwd[i+1]) - \
+                   (self.D[a, c] + self.D[b, d] + bwd[j] - bwd[i+1])
+            best = np.argmax(gain)
+            if gain[best] <= EPS:
+                break
+            i, j = i[best], j[best]
+            seq = seq[:i] + seq[i:j][::-1] + seq[j:]
+        return seq
+
+
+    def or_opt(self, v, seq, deadline):
+        improved = True
+        while improved and time.monotonic() < deadline:
+            improved = False
+            for length in (1, 2, 3):
+                if len(seq) <= length:
+                    continue
+                nodes = np.array(self.nodes(v, seq))
+                # Move the segment nodes[s..s+length-1] onto edge (nodes[k], nodes[k+1]).
+                s = np.arange(1, len(nodes) - length)
+                p, f, l, q = nodes[s-1], nodes[s], nodes[s+length-1], nodes[s+length]
+                removal = self.D[p, f] + self.D[l, q] - self.D[p, q]
+                k = np.arange(len(nodes) - 1)
+                a, b = nodes[k], nodes[k+1]
+                delta = self.D[a[None, :], f[:, None]] + self.D[l[:, None], b[None, :]] - \
+                        self.D[a, b][None, :] - removal[:, None]
+                delta[(k[None, :] >= s[:, None] - 1) & (k[None, :] <= s[:, None] + length - 1)] = np.inf
+                si, ki = np.unravel_index(np.argmin(delta), delta.shape)
+                if delta[si, ki] >= -EPS:
+                    continue
+                start = s[si] - 1
+                segment = seq[start:start+length]
+                rest = seq[:start] + seq[start+length:]
+                pos = ki if ki < start else ki - length
+                seq = rest[:pos] + segment + rest[pos:]
+                improved = True
+                break
+        return seq
+
+
+    def relocate(self, routes):
+        """Apply the best improving moves of single jobs between routes, at
+        most one per route. Returns whether any job moved."""
+        jobs, src, prev, nxt = [], [], [], []
+        a, b, dst, pos = [], [], [], []
+        for v, seq in enumerate(routes):
+            nodes = self.nodes(v, seq)
+            jobs += seq
+            src += [v] * len(seq)
+            prev += nodes[:-2]
+            nxt += nodes[2:]
+            a += nodes[:-1]
+            b += nodes[1:]
+            dst += [v] * (len(nodes) - 1)
+            pos += list(range(len(nodes) - 1))
+        if len(jobs) == 0:
+            return False
+        jobs, src, prev, nxt = map(np.array, (jobs, src, prev, nxt))
+        a, b, dst, pos = map(np.array, (a, b, dst, pos))
+        loads = np.array([self.load(seq) for seq in routes]).reshape(self.nv, self.dims)
+        times = np.array([self.route_time(v, seq) for v, seq in enumerate(routes)])
+
+        removal = self.D[prev, jobs] + self.D[jobs, nxt] - self.D[prev, nxt]
+        add = self.D[a[None, :], jobs[:, None]] + self.D[jobs[:, None], b[None, :]] - \
+              self.D[a, b][None, :]
+        fits = np.all(loads[None, :, :] + self.amount[jobs][:, None, :] <=
+                      self.capacity[None, :, :], axis=2)
+        feasible = fits[:, dst] & (src[:, None] != dst[None, :]) & \
+                   (times[dst][None, :] + add + self.service[jobs][:, None] <= self.limit[dst][None, :])
+        delta = np.where(feasible, add - removal[:, None], np.inf)
+        best = np.argmin(delta, axis=1)
+        gain = delta[np.arange(len(jobs)), best]
+
+        touched = set()
+        moved = False
+        for i in np.argsort(gain):
+            if gain[i] >= -EPS:
+                break
+            v1, v2 = src[i], dst[best[i]]
+            if v1 in touched or v2 in touched:
+                continue
+            routes[v1].remove(jobs[i])
+            routes[v2].insert(pos[best[i]], int(jobs[i]))
+            touched.update((v1, v2))
+            moved = True
+        return moved
+
+
+    def result(self, routes, unassigned, distances=None, geometry=False):
+        """Solution in the openrouteservice optimization response format."""
+        out_routes = []
+        for v, seq in enumerate(routes):
+            if len(seq) == 0:
+                continue
+            vehicle = self.vehicles[v]
+            nodes = self.nodes(v, seq)
+            load = self.load(seq)
+            amount = [int(x) for x in load]
+            arrival = self.ready[v]
+            travel = 0
+            distance = 0
+            steps = [{
+                'type': 'start',
+                'location': vehicle['start'],
+                'load': amount,
+                'arrival': int(round(arrival)),
+                'duration': 0,
+            }]
+            for prev, node in zip(nodes[:-1], nodes[1:]):
+                arrival += self.D[prev, node]
+                travel += self.D[prev, node]
+                if distances is not None:
+                    distance += distances[prev, node]
+                if node >= self.n:
+                    steps.append({
+                        'type': 'end',
+                        'location': vehicle['end'],
+                        'load': [0] * self.dims,
+                        'arrival': int(round(arrival)),
+                        'duration': int(round(travel)),
+                    })
+                    continue
+                load = load - self.amount[node]
+                steps.append({
+                    'type': 'job',
+                    'id': self.jobs[node]['id'],
+                    'job': self.jobs[node]['id'],
+                    'location': self.jobs[node]['location'],
+                    'load': [int(x) for x in load],
+                    'arrival': int(round(arrival)),
+                    'duration': int(round(travel)),
+                    'service': int(self.service[node]),
+                })
+                arrival += self.service[node]
+            route = {
+                'vehicle': vehicle['id'],
+                'cost': int(round(travel)),
+                'delivery': amount,
+                'amount': amount,
+                'pickup': [0] * self.dims,
+                'service': int(self.service[seq].sum()),
+                'duration': int(round(travel)),
+                'waiting_time': 0,
+                'steps': steps,
+            }
+            if distances is not None:
+                route['distance'] = int(round(distance))
+            if geometry:
+                route['geometry'] = encode_polyline([step['location'] for step in steps])
+            out_routes.append(route)
+        return {
+            'code': 0,
+            'summary': {
+                'cost': sum(route['cost'] for route in out_routes),
+                'unassigned': len(unassigned),
+                'delivery': [int(x) for x in self.amount.sum(axis=0) -
+                             self.amount[list(unassigned)].sum(axis=0)],
+                'service': sum(route['service'] for route in out_routes),
+                'duration': sum(route['duration'] for route in out_routes),
+                'waiting_time': 0,
+            },
+            'unassigned': [{'id': self.jobs[j]['id'],
+                            'location': self.jobs[j]['location'],
+                            'type': 'job'}
+                           for j in unassigned],
+            'routes': out_routes,
+        }
+
+
+def haversine_matrix(locations):
+    """Straight-line estimates of road (durations, distances) between
+    [lon, lat] locations."""
+    lon, lat = np.radians(np.asarray(locations, dtype=float).reshape(-1, 2)).T
+    a = np.sin((lat[:, None] - lat[None, :]) / 2)**2 + \
+        np.cos(lat[:, None]) * np.cos(lat[None, :]) * \
+        np.sin((lon[:, None] - lon[None, :]) / 2)**2
+    distances = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1))) * LOCAL_DETOUR
+    return distances / LOCAL_SPEED, distances
+
+
+def precomputed_matrix(matrix, locations):
+    """Travel time source answering from a single `matrix` lookup over
+    `locations`, for repeated solves among the same places."""
+    durations, distances = matrix(locations)
+    index = {MatrixService.key(lon, lat): i for i, (lon, lat) in enumerate(locations)}
+    
+    def lookup(requested):
+        idx = np.array([index[MatrixService.key(lon, lat)] for lon, lat in requested], dtype=int)
+        return durations[np.ix_(idx, idx)], distances[np.ix_(idx, idx)]
+    
+    return lookup
+
+
+def solve_clustered(solver, jobs, vehicles, num_clusters, matrix=None, geometry=False):
+    """Cluster-first, route-second solve. Jobs are swept by angle around the
+    first vehicle's start into clusters of similar workload, each cluster gets
+    a share of the vehicles proportional to its workload, and the clusters
+    are solved concurrently. Unassigned jobs are then offered to every
+    vehicle by cheapest feasible insertion over `matrix`."""
+    num_clusters = max(1, min(num_clusters, len(vehicles), len(jobs)))
+    weights = job_weights(jobs, vehicles[0])
+    clusters = sweep_clusters(jobs, vehicles[0]['start'], weights, num_clusters)
+    shares = vehicle_shares([weights[c].sum() for c in clusters], len(vehicles))
+    bounds = np.cumsum([0] + shares)
+    parts = [([jobs[j] for j in cluster], vehicles[bounds[k]:bounds[k+1]])
+             for k, cluster in enumerate(clusters)]
+    with ThreadPoolExecutor(max_workers=len(parts)) as executor:
+        results = list(executor.map(lambda part: solver.solve(*part, geometry=geometry),
+                                    parts))
+    plan = merge_plans(results)
+    return rebalance_plan(plan, solver, jobs, vehicles,
+                          matrix if matrix is not None else haversine_matrix,
+                          geometry)
+
+
+def job_weights(jobs, vehicle):
+    """Share of one vehicle's capacity or shift that each job takes up."""
+    capacity = np.asarray(vehicle.get('capacity', []), dtype=float)
+    amount = np.array([job.get('amount', [0] * len(capacity)) for job in jobs],
+                      dtype=float).reshape(len(jobs), len(capacity))
+    load = (amount / np.where(capacity > 0, capacity, np.inf)).max(axis=1, initial=0)
+    window = vehicle.get('time_window', [0, np.inf])
+    service = np.array([job.get('service', 0) for job in jobs], dtype=float) / \
+              (window[1] - window[0])
+    weights = np.maximum(load, service)
+    return weights + max(weights.mean(), 1) * EPS
+
+
+def sweep_clusters(jobs, center, weights, num_clusters):
+    """Split jobs into angular sectors around `center` of equal total weight,
+    starting the sweep at the widest empty sector."""
+    loc = np.array([job['location'] for job in jobs], dtype=float)
+    angles = np.arctan2(loc[:, 1] - center[1],
+                        (loc[:, 0] - center[0]) * np.cos(np.radians(center[1])))
+    order = np.argsort(angles, kind='stable')
+    sorted_angles = angles[order]
+    gaps = np.diff(np.append(sorted_angles, sorted_angles[0] + 2 * np.pi))
+    order = np.roll(order, -((np.argmax(gaps) + 1) % len(order)))
+    cum = np.cumsum(weights[order])
+    bounds = np.searchsorted(cum, cum[-1] * np.arange(1, num_clusters) / num_clusters)
+    return [c for c in np.split(order, bounds) if len(c) > 0]
+
+
+def vehicle_shares(weights, num_vehicles):
+    """At least one vehicle per cluster, the rest by largest remainder."""
+    weights = np.asarray(weights, dtype=float)
+    extra = num_vehicles - len(weights)
+    quota = extra * weights / weights.sum()
+    shares = np.floor(quota).astype(int)
+    remainder = extra - shares.sum()
+    shares[np.argsort(-(quota - shares), kind='stable')[:remainder]] += 1
+    return [int(x) + 1 for x in shares]
+
+
+def merge_plans(results):
+    """Combine optimization responses over disjoint jobs and vehicles."""
+    routes = sorted((route for result in results for route in result['routes']),
+                    key=lambda route: route['vehicle'])
+    unassigned = [una for result in results for una in result['unassigned']]
+    summary = {'routes': len(routes), 'unassigned': len(unassigned)}
+    for route in routes:
+        for key in ('cost', 'service', 'duration', 'waiting_time', 'distance'):
+            if key in route:
+                summary[key] = summary.get(key, 0) + route[key]
+        for key in ('delivery', 'amount', 'pickup'):
+            if key in route:
+                summary[key] = [a + b for a, b in
+                                zip(summary.get(key, [0] * len(route[key])), route[key])]
+    return {
+        'code': 0,
+        'summary': summary,
+        'unassigned': unassigned,
+        'routes': routes,
+    }
+
+
+def rebalance_plan(plan, solver, jobs, vehicles, matrix, geometry=False):
+    """Insert unassigned jobs into any vehicle with room for them, then
+    re-solve only the vehicles that received jobs."""
+    if len(plan['unassigned']) == 0:
+        return plan
+    job_index = {job['id']: j for j, job in enumerate(jobs)}
+    vehicle_index = {vehicle['id']: v for v, vehicle in enumerate(vehicles)}
+    durations, _ = matrix([job['location'] for job in jobs] +
+                          [v['start'] for v in vehicles] +
+                          [v['end'] for v in vehicles])
+    instance = VRPInstance(jobs, vehicles, durations)
+    routes = [[] for _ in vehicles]
+    for route in plan['routes']:
+        routes[vehicle_index[route['vehicle']]] = [
+            job_index[step_job_id(step)] for step in route['steps'] if step['type'] == 'job']
+    before = [list(seq) for seq in routes]
+    left = set(instance.insert(routes, [job_index[una['id']] for una in plan['unassigned']]))
+    changed = [v for v in range(len(vehicles)) if routes[v] != before[v]]
+    if len(changed) == 0:
+        return plan
+    with ThreadPoolExecutor(max_workers=len(changed)) as executor:
+        results = list(executor.map(
+            lambda v: solver.solve([jobs[j] for j in routes[v]], [vehicles[v]], geometry=geometry),
+            changed))
+    changed_ids = {vehicles[v]['id'] for v in changed}
+    kept = {'routes': [route for route in plan['routes'] if route['vehicle'] not in changed_ids],
+            'unassigned': [una for una in plan['unassigned']
+                           if job_index[una['id']] in left]}
+    return merge_plans([kept] + results)
+
+
+def colocated_groups(lat, lon, addresses, radius, address_radius=COALESCE_ADDRESS_RADIUS):
+    """Indices of beneficiaries grouped by location. Unassigned beneficiaries
+    seed groups in row order; a group takes every unassigned beneficiary
+    within `radius` meters of its seed, or within `address_radius` meters at
+    the same address, so no member is farther than that from the seed.
+    Matching addresses alone never merge rows, since vague addresses may
+    all resolve to the same town. The seed comes first in each group."""
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    n = len(lat)
+    if n == 0:
+        return []
+    keys = [None if address is None or (isinstance(address, float) and np.isnan(address))
+            else normalize_address(address) for address in addresses]
+    reach = max(radius, address_radius)
+    # Equirectangular meters are accurate enough at these distances.
+    y = np.radians(lat) * EARTH_RADIUS
+    x = np.radians(lon) * EARTH_RADIUS * np.cos(np.radians(lat.mean()))
+    cx = np.floor(x / reach).astype(int)
+    cy = np.floor(y / reach).astype(int)
+    cells = {}
+    for i, cell in enumerate(zip(cx, cy)):
+        cells.setdefault(cell, []).append(i)
+    assigned = np.zeros(n, dtype=bool)
+    groups = []
+    for seed in range(n):
+        if assigned[seed]:
+            continue
+        near = np.array([j for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+                         for j in cells.get((cx[seed] + dx, cy[seed] + dy), [])
+                         if not assigned[j]], dtype=int)
+        dist = np.hypot(x[near] - x[seed], y[near] - y[seed])
+        same = np.array([keys[j] is not None and keys[j] == keys[seed] for j in near],
+                        dtype=bool)
+        members = np.sort(near[(dist <= radius) | (same & (dist <= address_radius))])
+        assigned[members] = True
+        groups.append(members)
+    return groups
+
+
+def walk_times(jobs, group):
+    """Seconds spent walking between consecutive members of a group."""
+    locations = np.radians([jobs[j]['location'] for j in group])
+    dlon = np.diff(locations[:, 0]) * np.cos(locations[:-1, 1])
+    dlat = np.diff(locations[:, 1])
+    return np.hypot(dlon, dlat) * EARTH_RADIUS / WALK_SPEED
+
+
+def split_group(group, jobs, capacity):
+    """Split a group of job indices into consecutive parts whose summed amount
+    fits `capacity`."""
+    parts = [[]]
+    load = np.zeros_like(capacity)
+    for j in group:
+        amount = np.asarray(jobs[j]['amount'])
+        if len(parts[-1]) > 0 and np.any(load + amount > capacity):
+            parts.append([])
+            load = np.zeros_like(capacity)
+        parts[-1].append(int(j))
+        load = load + amount
+    return parts
+
+
+def merge_jobs(jobs, groups, service_scale):
+    """One job per group at its first member's location, with the summed
+    amount and a service time growing by `service_scale` stops per extra
+    member, plus the walks between members."""
+    return [{**jobs[group[0]],
+             'id': k,
+             'amount': [int(x) for x in np.sum([jobs[j]['amount'] for j in group], axis=0)],
+             'service': int(round(max(jobs[j]['service'] for j in group) *
+                                  (1 + service_scale * (len(group) - 1)) +
+                                  walk_times(jobs, group).sum()))}
+            for k, group in enumerate(groups)]
+
+
+def expand_plan(plan, jobs, groups):
+    """Plan of merged jobs expanded to one step per member job, delivered
+    one after another within the merged stop's service time, walking
+    between members."""
+    routes = []
+    for route in plan['routes']:
+        steps = []
+        for step in route['steps']:
+            if step['type'] != 'job':
+                steps.append(step)
+                continue
+            group = groups[step_job_id(step)]
+            load = np.asarray(step['load']) + np.sum([jobs[j]['amount'] for j in group], axis=0)
+            arrival = step['arrival']
+            walks = walk_times(jobs, group)
+            service = max(step.get('service', 0) - walks.sum(), 0) / len(group)
+            for k, j in enumerate(group):
+                if k > 0:
+                    arrival += walks[k-1]
+                load = load - jobs[j]['amount']
+                steps.append({**step,
+                              'id': jobs[j]['id'],
+                              'job': jobs[j]['id'],
+                              'location': jobs[j]['location'],
+                              'load': [int(x) for x in load],
+                              'arrival': int(round(arrival)),
+                              'service': int(round(service))})
+                arrival += service
+        routes.append({**route, 'steps': steps})
+    unassigned = [{**una, 'id': jobs[j]['id'], 'location': jobs[j]['location']}
+                  for una in plan['unassigned'] for j in groups[una['id']]]
+    return {**plan,
+            'summary': {**plan.get('summary', {}), 'unassigned': len(unassigned)},
+            'routes': routes,
+            'unassigned': unassigned}
+
+
+def save_plan(plan, jobs, keys, vehicles, path=LAST_PLAN_JSON):
+    """Store a plan by beneficiary key so it can be updated next time."""
+    key_of = {job['id']: key for job, key in zip(jobs, keys)}
+    snapshot = {
+        'vehicles': vehicles,
+        'jobs': {key: job_signature(job) for job, key in zip(jobs, keys)},
+        'routes': [{'vehicle': route['vehicle'],
+                    'jobs': [key_of[step_job_id(step)] for step in route['steps']
+                             if step['type'] == 'job'],
+                    'route': route}
+                   for route in plan['routes']],
+        'unassigned': [key_of[una['id']] for una in plan['unassigned']],
+    }
+    with open(path, 'w') as f:
+        json.dump(snapshot, f)
+
+
+def job_signature(job):
+    return {key: job.get(key) for key in ('location', 'amount', 'service')}
+
+
+def reoptimize(last, jobs, keys, vehicles, matrix, solver, geometry=False):
+    """Update the stored plan `last` for the current jobs: drop removed
+    stops and insert new or changed ones by cheapest feasible insertion over
+    `matrix`. Routes that keep their stops keep their stored steps and
+    timings; only the vehicles whose stops changed are re-solved with
+    `solver`. Returns None when a full solve is due instead: the fleet
+    changed, more than REOPT_MAX_CHANGE of the jobs changed, more jobs go
+    unassigned, or the travel time per stop grows by more than
+    REOPT_MAX_DEGRADATION."""
+    if last['vehicles'] != json.loads(json.dumps(vehicles)):
+        return None
+    current = {key: json.loads(json.dumps(job_signature(job))) for job, key in zip(jobs, keys)}
+    kept = {key for key in current if last['jobs'].get(key) == current[key]}
+    num_changed = len(current) + len(last['jobs']) - 2 * len(kept)
+    if num_changed > REOPT_MAX_CHANGE * max(len(current), 1):
+        return None
+
+    vehicle_index = {vehicle['id']: v for v, vehicle in enumerate(vehicles)}
+    starts = [v['start'] for v in vehicles] + [v['end'] for v in vehicles]
+    old_keys = list(last['jobs'])
+    old_index = {key: j for j, key in enumerate(old_keys)}
+    old_jobs = [last['jobs'][key] for key in old_keys]
+    old = VRPInstance(old_jobs, vehicles,
+                      matrix([job['location'] for job in old_jobs] + starts)[0])
+    old_cost = sum(old.travel(vehicle_index[route['vehicle']],
+                              [old_index[key] for key in route['jobs']])
+                   for route in last['routes'])
+    old_stops = sum(len(route['jobs']) for route in last['routes'])
+
+    index = {key: j for j, key in enumerate(keys)}
+    durations, _ = matrix([job['location'] for job in jobs] + starts)
+    instance = VRPInstance(jobs, vehicles, durations)
+    routes = [[] for _ in vehicles]
+    stored = [None for _ in vehicles]
+    for route in last['routes']:
+        v = vehicle_index[route['vehicle']]
+        routes[v] = [index[key] for key in route['jobs'] if key in kept]
+        if len(routes[v]) == len(route['jobs']) and 'route' in route:
+            stored[v] = route['route']
+    before = [list(seq) for seq in routes]
+    for v, seq in enumerate(routes):
+        if np.any(instance.load(seq) > instance.capacity[v]) or \
+            instance.route_time(v, seq) > instance.limit[v]:
+            return None
+    assigned = {j for seq in routes for j in seq}
+    left = instance.insert(routes, [j for j in range(len(jobs)) if j not in assigned])
+    if len(left) > len(last['unassigned']):
+        return None
+    cost = sum(instance.travel(v, seq) for v, seq in enumerate(routes))
+    stops = len(jobs) - len(left)
+    if old_stops > 0 and stops > 0 and \
+        cost / stops > (1 + REOPT_MAX_DEGRADATION) * old_cost / old_stops:
+        return None
+
+    unchanged = {'routes': [], 'unassigned': [{'id': jobs[j]['id'],
+                                               'location': jobs[j]['location'],
+                                               'type': 'job'} for j in left]}
+    changed = []
+    for v, seq in enumerate(routes):
+        if stored[v] is not None and seq == before[v] and \
+                (not geometry or 'geometry' in stored[v]):
+            route = json.loads(json.dumps(stored[v]))
+            ids = iter(seq)
+            for step in route['steps']:
+                if step['type'] == 'job':
+                    j = next(ids)
+                    step.update({field: jobs[j]['id'] for field in ('id', 'job')
+                                 if field in step})
+            unchanged['routes'].append(route)
+        elif len(seq) > 0:
+            changed.append(v)
+    if len(changed) == 0:
+        return merge_plans([unchanged])
+    with ThreadPoolExecutor(max_workers=len(changed)) as executor:
+        results = list(executor.map(
+            lambda v: solver.solve([jobs[j] for j in routes[v]], [vehicles[v]], geometry=geometry),
+            changed))
+    return merge_plans([unchanged] + results)
+
+
+class MatrixService:
+    """Duration and distance matrix over every location seen so far, stored in
+    `path` as memory-mapped float32 arrays with a coordinate index. Pairs that
+    are not stored yet are fetched from the ORS matrix endpoint in tiles of
+    at most `tile` sources by `tile` destinations, so adding locations only
+    costs their new rows and columns.
+
+    Calling the service with a list of [lon, lat] locations returns their
+    (durations, distances), so it can be passed as a LocalSolver matrix."""
+
+    def __init__(self,
+                 client,
+                 path=MATRIX_DIR,
+                 profile='driving-car',
+                 tile=MATRIX_TILE,
+                 workers=MATRIX_WORKERS,
+                 metrics=None):
+        self.client = client
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.path = path
+        self.profile = profile
+        self.tile = tile
+        self.workers = workers
+        self.num_api_calls = 0
+        self.lock = threading.Lock()
+        self.update_lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        index_file = os.path.join(path, 'index.json')
+        if os.path.exists(index_file):
+            with open(index_file) as f:
+                index = json.load(f)
+            if index['profile'] != profile:
+                raise ValueError(f'Matrix cache {path} holds {index["profile"]} '
+                                 f'travel times, not {profile}.')
+            self.size = index['size']
+            self.coords = np.load(self.file('coords'), mmap_mode='r+')
+            self.durations = np.load(self.file('durations'), mmap_mode='r+')
+            self.distances = np.load(self.file('distances'), mmap_mode='r+')
+        else:
+            self.size = 0
+            self.allocate(64)
+        self.keys = {self.key(lon, lat): i
+                     for i, (lon, lat) in enumerate(self.coords[:self.size])}
+
+
+    def file(self, name):
+        return os.path.join(self.path, f'{name}.npy')
+
+
+    @staticmethod
+    def key(lon, lat):
+        return (round(float(lon), PRECISION), round(float(lat), PRECISION))
+
+
+    def allocate(self, capacity):
+        """Grow the stored arrays to hold `capacity` locations."""
+        n = self.size
+        for name, dtype, shape in (('coords', np.float64, (capacity, 2)),
+                                   ('durations', np.float32, (capacity, capacity)),
+                                   ('distances', np.float32, (capacity, capacity))):
+            tmp = self.file(f'{name}.tmp')
+            array = np.lib.format.open_memmap(tmp, mode='w+', dtype=dtype, shape=shape)
+            array[:] = np.nan
+            if n > 0:
+                block = (slice(n),) if name == 'coords' else (slice(n), slice(n))
+                array[block] = getattr(self, name)[block]
+            array.flush()
+            del array
+            os.replace(tmp, self.file(name))
+            setattr(self, name, np.load(self.file(name), mmap_mode='r+'))
+        self.save_index()
+
+
+    def save_index(self):
+        with open(os.path.join(self.path, 'index.json'), 'w') as f:
+            json.dump({'profile': self.profile, 'size': self.size}, f)
+
+
+    def add(self, locations):
+        """Matrix indices of `locations`, registering unseen ones."""
+        indices = []
+        new = []
+        for lon, lat in locations:
+            key = self.key(lon, lat)
+            if key not in self.keys:
+                self.keys[key] = self.size + len(new)
+                new.append(key)
+            indices.append(self.keys[key])
+        if len(new) > 0:
+            needed = self.size + len(new)
+            if needed > len(self.coords):
+                self.allocate(max(needed, 2 * len(self.coords)))
+            self.coords[self.size:needed] = new
+            for i in range(self.size, needed):
+                self.durations[i, i] = 0
+                self.distances[i, i] = 0
+            self.size = needed
+            self.coords.flush()
+            self.save_index()
+        return np.array(indices, dtype=int)
+
+
+    def fetch(self, sources, destinations):
+        """Fill the stored block sources x destinations from ORS, one tile per
+        request."""
+        tiles = [(sources[i:i+self.tile], destinations[j:j+self.tile])
+                 for i in range(0, len(sources), self.tile)
+                 for j in range(0, len(destinations), self.tile)]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for src, dst, response in executor.map(lambda t: (*t, self.fetch_tile(*t)), tiles):
+                self.durations[np.ix_(src, dst)] = matrix_values(response['durations'])
+                self.distances[np.ix_(src, dst)] = matrix_values(response['distances'])
+        self.durations.flush()
+        self.distances.flush()
+
+
+    def fetch_tile(self, src, dst):
+        locations = [list(self.coords[i]) for i in src] + [list(self.coords[i]) for i in dst]
+        with self.lock:
+            self.num_api_calls += 1
+        with self.metrics.call('ors_matrix'):
+            return self.client.distance_matrix(locations=locations,
+                                               profile=self.profile,
+                                               sources=list(range(len(src))),
+                                               destinations=list(range(len(src), len(locations))),
+                                               metrics=['duration', 'distance'])
+
+
+    def get(self, locations):
+        # Concurrent solves share the service; growing the stored arrays and
+        # filling them must not interleave.
+        with self.update_lock:
+            return self.lookup(locations)
+
+
+    def lookup(self, locations):
+        idx = self.add(locations)
+        unique = np.unique(idx)
+        missing = np.isnan(self.durations[np.ix_(unique, unique)])
+        # Locations without any stored pair get their full row and column.
+        new = unique[missing.sum(axis=1) >= len(unique) - 1]
+        if len(new) > 0:
+            self.fetch(new, unique)
+            self.fetch(np.setdiff1d(unique, new), new)
+            missing = np.isnan(self.durations[np.ix_(unique, unique)])
+        if missing.any():
+            self.fetch(unique[missing.any(axis=1)], unique[missing.any(axis=0)])
+        return (np.asarray(self.durations[np.ix_(idx, idx)], dtype=float),
+                np.asarray(self.distances[np.ix_(idx, idx)], dtype=float))
+
+
+    __call__ = get
+
+
+def matrix_values(rows):
+    """ORS matrix rows as an array, with unreachable pairs set to infinity."""
+    return np.array([[np.inf if x is None else x for x in row] for row in rows],
+                    dtype=np.float32)
+
+
+def decode_polyline(encoded, precision=5):
+    """Decode a Google encoded polyline into an (n, 2) array of (lat, lon)."""
+    chunks = np.frombuffer(encoded.encode('ascii'), dtype=np.uint8).astype(np.int64) - 63
+    if len(chunks) == 0:
+        return np.zeros((0, 2))
+    ends = (chunks & 0x20) == 0
+    value_of = np.concatenate([[0], np.cumsum(ends)[:-1]])
+    starts = np.flatnonzero(np.concatenate([[True], ends[:-1]]))
+    shift = 5 * (np.arange(len(chunks)) - starts[value_of])
+    values = np.zeros(ends.sum(), dtype=np.int64)
+    np.add.at(values, value_of, (chunks & 0x1f) << shift)
+    deltas = np.where(values & 1, ~(values >> 1), values >> 1)
+    return np.cumsum(deltas.reshape(-1, 2), axis=0) / 10**precision
+
+
+def simplify_polyline(points, tolerance):
+    """Douglas-Peucker simplification of (lat, lon) points, keeping every
+    point further than `tolerance` degrees from the simplified line."""
+    points = np.asarray(points, dtype=float)
+    if len(points) < 3 or tolerance <= 0:
+        return points
+    # Work in locally equirectangular coordinates so tolerance is isotropic.
+    xy = np.column_stack([points[:, 1] * np.cos(np.radians(points[:, 0].mean())),
+                          points[:, 0]])
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        a, b = xy[first], xy[last]
+        between = xy[first+1:last]
+        ab = b - a
+        length = np.hypot(*ab)
+        if length == 0:
+            dist = np.hypot(*(between - a).T)
+        else:
+            dist = np.abs(ab[0] * (between[:, 1] - a[1]) - ab[1] * (between[:, 0] - a[0])) / length
+        k = np.argmax(dist)
+        if dist[k] > tolerance:
+            mid = first + 1 + k
+            keep[mid] = True
+            stack += [(first, mid), (mid, last)]
+    return points[keep]
+
+
+def zoom_tolerance(zoom, lat, pixels=1):
+    """Degrees covered by `pixels` screen pixels at a web map zoom level."""
+    return pixels * 360 / (256 * 2**zoom) * np.cos(np.radians(lat))
+
+
+def encode_polyline(coords):
+    """Encode [lon, lat] coordinates as a Google encoded polyline, the
+    inverse of ors.convert.decode_polyline."""
+    encoded = ''
+    prev_lat, prev_lon = 0, 0
+    for lon, lat in coords:
+        lat, lon = int(round(lat * 1e5)), int(round(lon * 1e5))
+        for value in (lat - prev_lat, lon - prev_lon):
+            value = ~(value << 1) if value < 0 else value << 1
+            while value >= 0x20:
+                encoded += chr((0x20 | (value & 0x1f)) + 63)
+                value >>= 5
+            encoded += chr(value + 63)
+        prev_lat, prev_lon = lat, lon
+    return encoded
+
+
+def fetch_route_geometry(client, locations, profile='driving-car', metrics=None):
+    """Encoded road polyline through [lon, lat] `locations` from the ORS
+    directions endpoint, requested in legs of at most
+    DIRECTIONS_MAX_WAYPOINTS waypoints."""
+    metrics = metrics if metrics is not None else Metrics()
+    step = DIRECTIONS_MAX_WAYPOINTS - 1
+    lines = []
+    for first in range(0, max(len(locations) - 1, 1), step):
+        with metrics.call('ors_directions'):
+            response = client.directions(coordinates=locations[first:first+step+1],
+                                         profile=profile,
+                                         format='json',
+                                         instructions=False)
+        line = decode_polyline(response['routes'][0]['geometry'])
+        lines.append(line if first == 0 else line[1:])
+    return encode_polyline(np.concatenate(lines)[:, ::-1])
+
+
 def get_xl_col(df: pd.DataFrame, *keys):
     keys = [key.lower() for key in keys]
     for i,col in enumerate(df.columns):
@@ -465,15 +2407,313 @@ def get_xl_col(df: pd.DataFrame, *keys):
 
 
 def get_col(df: pd.DataFrame, key, threshold=0.9):
-    sims = string_similarity(key, *df.columns)
-    col = np.argmax(sims)
-    if sims[col] < threshold:
-        return None
-    return col
+    return HeaderMatcher(df.columns).match([key], threshold=threshold)[key]['column']
+
+
+class HeaderMatcher:
+    """Matches expected header names to a sheet's columns. Each string is
+    sketched once as the hashed ids of its character k-grams, and every key
+    is scored against every column in one NumPy pass by multiset Jaccard
+    similarity, counting only the grams that occur in the keys."""
+
+    def __init__(self, columns, k=3):
+        self.columns = [str(col) for col in columns]
+        self.k = k
+        self.sketches = self.sketch(self.columns)
+
+
+    def sketch(self, strings):
+        size = 2**HEADER_SKETCH_BITS
+        sketches = []
+        for string in strings:
+            string = string.lower()
+            grams = [string[j:j+self.k] for j in range(len(string)-self.k+1)] or [string]
+            sketches.append(np.array([zlib.crc32(g.encode()) % size for g in grams]))
+        return sketches
+
+
+    @staticmethod
+    def counts(sketches, vocab):
+        """Gram counts of every sketch (rows) over `vocab` (columns)."""
+        rows = np.repeat(np.arange(len(sketches)), [len(ids) for ids in sketches])
+        ids = np.concatenate(sketches + [np.zeros(0, dtype=int)]).astype(int)
+        idx = np.minimum(np.searchsorted(vocab, ids), len(vocab) - 1)
+        found = vocab[idx] == ids
+        counts = np.zeros((len(sketches), len(vocab)), dtype=np.float32)
+        np.add.at(counts, (rows[found], idx[found]), 1)
+        return counts
+
+
+    def scores(self, keys):
+        """Similarity of every key (rows) to every column (columns)."""
+        sketches = self.sketch(keys)
+        vocab = np.unique(np.concatenate(sketches))
+        K = self.counts(sketches, vocab)
+        C = self.counts(self.sketches, vocab)
+        inter = np.minimum(K[:, None, :], C[None, :, :]).sum(axis=2)
+        union = np.array([len(ids) for ids in sketches], dtype=np.float32)[:, None] + \
+                np.array([len(ids) for ids in self.sketches], dtype=np.float32)[None, :] - inter
+        return inter / np.where(union > 0, union, 1)
+
+
+    def match(self, keys, threshold=0.9, num_suggestions=3):
+        """Assign each key its own column, best scoring pairs first. Returns,
+        per key, the column index (None below `threshold`), the confidence of
+        the match and the closest column names as suggestions."""
+        scores = self.scores(keys)
+        best = np.argsort(-scores, axis=1, kind='stable')[:, :num_suggestions]
+        result = {key: {'column': None,
+                        'confidence': float(scores[i].max(initial=0)),
+                        'suggestions': [self.columns[j] for j in best[i]]}
+                  for i, key in enumerate(keys)}
+        used_keys, used_cols = set(), set()
+        for flat in np.argsort(-scores, axis=None, kind='stable'):
+            i, j = divmod(int(flat), len(self.columns))
+            if scores[i, j] < threshold:
+                break
+            if i in used_keys or j in used_cols:
+                continue
+            used_keys.add(i)
+            used_cols.add(j)
+            result[keys[i]]['column'] = j
+            result[keys[i]]['confidence'] = float(scores[i, j])
+        return result
 
 
 def get_excel_column_letter(index):
-    return 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'[index]
+    letters = ''
+    index += 1
+    while index > 0:
+        index, rem = divmod(index - 1, 26)
+        letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'[rem] + letters
+    return letters
+
+
+def get_excel_column_index(letters):
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index - 1
+
+
+def write_cells(path, updates):
+    """Write `updates`, a {(Excel row, column index): value} map, into the
+    first worksheet of the workbook at `path`. Only the affected rows of the
+    sheet XML are rewritten; workbooks the patch cannot handle are loaded
+    and saved with openpyxl instead."""
+    try:
+        patch_xlsx_cells(path, updates)
+    except (ValueError, KeyError, zipfile.BadZipFile):
+        import openpyxl as xl
+        wb = xl.load_workbook(path)
+        ws = wb.worksheets[0]
+        for (r, c), value in updates.items():
+            ws.cell(row=r, column=c+1).value = value
+        wb.save(path)
+
+
+XLSX_ROW = re.compile(r'<row\b([^>]*?)(?:/>|>(.*?)</row>)', re.S)
+XLSX_CELL = re.compile(r'<c\b([^>]*?)(?:/>|>(.*?)</c>)', re.S)
+
+
+def patch_xlsx_cells(path, updates):
+    by_row = {}
+    for (r, c), value in updates.items():
+        by_row.setdefault(r, {})[c] = value
+    patched_rows = set()
+
+    def patch_row(match):
+        attrs, body = match.group(1), match.group(2) or ''
+        r = re.search(r'\br="(\d+)"', attrs)
+        if r is None:
+            raise ValueError('Worksheet rows without explicit row numbers.')
+        r = int(r.group(1))
+        if r not in by_row:
+            return match.group(0)
+        cells = {}
+        pos = 0
+        for cell in XLSX_CELL.finditer(body):
+            ref = re.search(r'\br="([A-Z]+)\d+"', cell.group(1))
+            if body[pos:cell.start()].strip() or ref is None:
+                raise ValueError(f'Unexpected content in worksheet row {r}.')
+            pos = cell.end()
+            cells[get_excel_column_index(ref.group(1))] = (cell.group(0), cell.group(1))
+        if body[pos:].strip():
+            raise ValueError(f'Unexpected content in worksheet row {r}.')
+        for c, value in by_row[r].items():
+            style = re.search(r'\ss="\d+"', cells[c][1]) if c in cells else None
+            cells[c] = (xlsx_cell(r, c, value, style.group(0) if style else ''), '')
+        patched_rows.add(r)
+        attrs = re.sub(r'\s+spans="[^"]*"', '', attrs)
+        return f'<row{attrs}>{"".join(cells[c][0] for c in sorted(cells))}</row>'
+
+    with zipfile.ZipFile(path) as zf:
+        sheet = first_sheet_path(zf)
+        xml = XLSX_ROW.sub(patch_row, zf.read(sheet).decode('utf-8'))
+        if patched_rows != set(by_row):
+            raise ValueError('Some rows to update are not in the worksheet.')
+        tmp = f'{path}.tmp'
+        with zipfile.ZipFile(tmp, 'w') as out:
+            for info in zf.infolist():
+                out.writestr(info, xml.encode('utf-8') if info.filename == sheet
+                             else zf.read(info.filename))
+    os.replace(tmp, path)
+
+
+def first_sheet_path(zf):
+    """Archive path of the first worksheet of an xlsx workbook."""
+    workbook = zf.read('xl/workbook.xml').decode('utf-8')
+    sheet = re.search(r'<(?:\w+:)?sheet\b[^>]*\br:id="([^"]+)"', workbook)
+    if sheet is None:
+        raise KeyError('sheet')
+    rid = sheet.group(1)
+    rels = zf.read('xl/_rels/workbook.xml.rels').decode('utf-8')
+    for rel in re.finditer(r'<Relationship\b[^>]*>', rels):
+        if re.search(rf'\bId="{re.escape(rid)}"', rel.group(0)):
+            target = re.search(r'\bTarget="([^"]+)"', rel.group(0))
+            if target is None:
+                raise KeyError(rid)
+            target = target.group(1)
+            return target.lstrip('/') if target.startswith('/') else f'xl/{target}'
+    raise KeyError(rid)
+
+
+def xlsx_cell(r, c, value, style=''):
+    ref = f'{get_excel_column_letter(c)}{r}'
+    if value is None:
+        return f'<c r="{ref}"{style}/>'
+    if isinstance(value, (float, np.floating)):
+        return f'<c r="{ref}"{style}><v>{float(value)!r}</v></c>'
+    if isinstance(value, (int, np.integer)) and not isinstance(value, bool):
+        return f'<c r="{ref}"{style}><v>{int(value)}</v></c>'
+    return (f'<c r="{ref}"{style} t="inlineStr"><is>'
+            f'<t xml:space="preserve">{xml_escape(str(value))}</t></is></c>')
+
+
+class AddressIndex:
+    """Fuzzy index of geocoded street addresses. Addresses are reduced by
+    street_address and compared by the Dice similarity of their character
+    3-grams. Candidates come from an inverted index on the house number, or
+    on 3-grams for addresses without one, and must agree on every number,
+    and on the town and ZIP code where both addresses give them."""
+
+    def __init__(self, k=3):
+        self.k = k
+        self.entries = []
+        self.by_number = {}
+        self.by_gram = {}
+
+
+    def grams(self, text):
+        text = f' {text} '
+        return {text[i:i+self.k] for i in range(len(text) - self.k + 1)}
+
+
+    def add(self, address, place):
+        text = street_address(address)
+        if not text:
+            return
+        grams = self.grams(text)
+        numbers = re.findall(r'\d+\w*', text)
+        # Typed addresses often leave the town out; the place still has one.
+        locality = tuple(a if a is not None else b for a, b in
+                         zip(address_locality(address), address_locality(place['address'])))
+        self.entries.append((grams, numbers, locality, place))
+        if numbers:
+            self.by_number.setdefault(numbers[0], []).append(len(self.entries) - 1)
+        else:
+            for gram in grams:
+                self.by_gram.setdefault(gram, []).append(len(self.entries) - 1)
+
+
+    def match(self, address, threshold=ADDRESS_MATCH_THRESHOLD):
+        """Place of the most similar indexed address, if at least `threshold`."""
+        text = street_address(address)
+        if not text:
+            return None
+        grams = self.grams(text)
+        numbers = re.findall(r'\d+\w*', text)
+        locality = address_locality(address)
+        if numbers:
+            candidates = self.by_number.get(numbers[0], [])
+        else:
+            candidates = {e for gram in grams for e in self.by_gram.get(gram, [])}
+        best, best_score = None, threshold
+        for e in candidates:
+            other, other_numbers, other_locality, place = self.entries[e]
+            if other_numbers != numbers or \
+                any(a is not None and b is not None and a != b
+                    for a, b in zip(locality, other_locality)):
+                continue
+            score = 2 * len(grams & other) / (len(grams) + len(other))
+            if score >= best_score:
+                best, best_score = place, score
+        return best
+
+
+def street_address(address):
+    """Street part of an address, before the first comma, lowercased, with
+    unit designations removed and common abbreviations expanded."""
+    text = re.sub(r'#', ' # ', str(address).split(',')[0].lower())
+    words = []
+    skip = False
+    for word in re.sub(r'[^\w#]+', ' ', text).split():
+        if word in ADDRESS_UNITS:
+            skip = True
+        elif skip:
+            skip = False
+        else:
+            words.append(ADDRESS_ABBREVIATIONS.get(word, word))
+    return ' '.join(words)
+
+
+def address_locality(address):
+    """(town, ZIP code) of an address from its parts after the first comma,
+    each None if not given."""
+    town, zip_code = None, None
+    for part in str(address).lower().split(',')[1:]:
+        words = re.sub(r'[^\w]+', ' ', part).split()
+        codes = [word for word in words if re.fullmatch(r'\d{5}', word)]
+        if codes:
+            zip_code = codes[0]
+        words = [word for word in words if not word.isdigit()]
+        # A state abbreviation, optionally before the ZIP code, or the country.
+        if len(words) == 0 or (len(words) == 1 and len(words[0]) == 2) or \
+            ' '.join(words) in ('usa', 'united states', 'united states of america'):
+            continue
+        if town is None:
+            town = ' '.join(words)
+    return town, zip_code
+
+
+def read_geocode_journal(path, pending):
+    """Journaled lookups of the (row, name, address) `pending` rows, by row,
+    skipping rows whose address changed since."""
+    addresses = {r: str(addr) for r, _, addr in pending}
+    resolved = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash.
+                    continue
+                if addresses.get(entry['row']) == entry['address']:
+                    resolved[entry['row']] = entry
+    except OSError:
+        pass
+    return resolved
+
+
+def append_geocode_journal(path, entries):
+    if len(entries) == 0:
+        return
+    with open(path, 'a') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
 
 
 def extract_google_place(place):
@@ -492,28 +2732,8 @@ def extract_google_place(place):
     return extract
 
 
-def k_shingles(string, k=3):
-    string = string.lower()
-    shingles = Multiset()
-    for i in range(len(string)-k+1):
-        shingles.add(tuple(string[i:i+k]))
-    return shingles
-
-
-def jaccard_similarity(a: Multiset, b: Multiset):
-    if len(a | b) == 0:
-        print(a)
-        print(b)
-    return len(a & b) / len(a | b)
-
-
 def string_similarity(test, *args):
-    k = max(len(test), 3)
-    test_shingles = k_shingles(test, k)
-    sims = np.zeros(len(args))
-    for i,arg in enumerate(args):
-        sims[i] = jaccard_similarity(test_shingles, k_shingles(arg, k))
-    return sims
+    return HeaderMatcher(args).scores([test])[0]
 
 
 def hrs_mins_from_secs(secs):
@@ -530,6 +2750,7 @@ def hrs_mins_from_secs(secs):
 
 
 def set_popup_background(m, color='#303030'):
+    import folium
     html_to_insert = ("<style>"
                       ".leaflet-popup-content-wrapper, "
                       ".leaflet-popup-tip {background-color: "
@@ -547,23 +2768,536 @@ def set_popup_background(m, color='#303030'):
     m.get_root().header.add_child(folium.Element(html_to_insert))
 
 
+def set_popup_style(m):
+    """Style popups that are not wrapped in their own IFrame."""
+    import folium
+    m.get_root().header.add_child(folium.Element(f'<style>{POPUP_STYLE}</style>'))
+
+
+def cell_text(value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return ''
+    return str(value)
+
+
 def nominatim_extract_query(query):
     """Convert to /search route format."""
     if isinstance(query, str):
         query = {'q': query}
     else:
         assert isinstance(query, dict)
+        # The caller's dict is also its cache key.
+        query = dict(query)
     query['format'] = 'json'
     return query
     
     
-def nominatim_search(*args):
+def nominatim_search(*args, cache=None, metrics=None):
     """Query Open Street Map's Nominatim API's /search route."""
-    route = 'https://nominatim.openstreetmap.org/search'
-    responses = [requests.get(route, params=nominatim_extract_query(arg)).json() for arg in args]
+    route = NOMINATIM_URL
+    cache = cache if cache is not None else default_geocode_cache()
+    metrics = metrics if metrics is not None else Metrics()
+    responses = []
+    for arg in args:
+        response = cache.get('nominatim', arg)
+        if response is None:
+            with metrics.call('nominatim'):
+                r = requests.get(route, params=nominatim_extract_query(arg),
+                                 hooks={'response': [metrics.count_attempt]})
+                response = r.json()
+            # Error payloads are objects; only cache actual search results.
+            if r.ok and isinstance(response, list):
+                cache.put('nominatim', arg, response)
+        responses.append(response)
     return responses
 
 
+def normalize_address(address):
+    """Canonical form of an address used as a geocode cache key."""
+    if isinstance(address, dict):
+        return json.dumps(address, sort_keys=True)
+    return ' '.join(re.sub(r'[^\w#]+', ' ', str(address).lower()).split())
+
+
+class LocalStorage:
+    """Beneficiaries workbook kept in a local file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = path
+
+
+    def download(self, dest):
+        if os.path.abspath(self.path) != os.path.abspath(dest):
+            shutil.copyfile(self.path, dest)
+
+
+    def upload(self, src):
+        if os.path.abspath(self.path) != os.path.abspath(src):
+            shutil.copyfile(src, self.path)
+
+
+class DriveStorage:
+    """Beneficiaries workbook kept on Google Drive, authenticated as the
+    Colab user. The Drive md5 and modified date of the last synced version
+    are kept next to the local copy, so an unchanged file is not downloaded
+    again and a file edited on Drive since is not overwritten."""
+
+    def __init__(self, file_id, metrics=None):
+        from google.colab import auth
+        from oauth2client.client import GoogleCredentials
+        from pydrive.auth import GoogleAuth
+        from pydrive.drive import GoogleDrive
+        
+        auth.authenticate_user()
+        gauth = GoogleAuth()
+        gauth.credentials = GoogleCredentials.get_application_default()
+        self.gdrive = GoogleDrive(gauth)
+        self.file_id = file_id
+        self.name = file_id
+        self.metrics = metrics if metrics is not None else Metrics()
+
+
+    def metadata(self):
+        beneficiaries_file = self.gdrive.CreateFile({'id': self.file_id})
+        with self.metrics.call('drive_metadata'):
+            beneficiaries_file.FetchMetadata(fields='md5Checksum,modifiedDate')
+        return beneficiaries_file, {'id': self.file_id,
+                                    'md5Checksum': beneficiaries_file['md5Checksum'],
+                                    'modifiedDate': beneficiaries_file['modifiedDate']}
+
+
+    def synced(self, path):
+        """Drive metadata recorded when `path` was last synced, if any."""
+        try:
+            with open(f'{path}.sync.json') as f:
+                synced = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if synced.get('id') != self.file_id or not os.path.exists(path):
+            return None
+        return synced
+
+
+    def mark_synced(self, path, remote):
+        with open(f'{path}.sync.json', 'w') as f:
+            json.dump(remote, f)
+
+
+    def download(self, dest):
+        beneficiaries_file, remote = self.metadata()
+        synced = self.synced(dest)
+        if synced is not None:
+            local_md5 = file_md5(dest)
+            if local_md5 == remote['md5Checksum']:
+                print('The local copy is up to date. Skipping download.')
+                self.mark_synced(dest, remote)
+                return
+            if local_md5 != synced['md5Checksum']:
+                root, ext = os.path.splitext(dest)
+                shutil.copyfile(dest, f'{root}.unsynced{ext}')
+                print(f'{yellow("WARNING:")} The local copy had changes that were never '
+                      f'uploaded. They were saved to {root}.unsynced{ext}.')
+        with self.metrics.call('drive_download') as call:
+            beneficiaries_file.GetContentFile(dest)
+            call['received'] = os.path.getsize(dest)
+        self.mark_synced(dest, remote)
+
+
+    def upload(self, src):
+        """Upload `src` if it differs from Drive. Raises OSError if the file
+        was changed on Drive since it was downloaded."""
+        beneficiaries_file, remote = self.metadata()
+        md5 = file_md5(src)
+        if md5 == remote['md5Checksum']:
+            return
+        synced = self.synced(src) or {}
+        if synced.get('md5Checksum') != remote['md5Checksum']:
+            raise OSError(f'The beneficiaries file was changed on Google Drive '
+                          f'({remote["modifiedDate"]}) since it was downloaded. '
+                          'Not overwriting it; the changes are kept locally in '
+                          f'{src}. Please merge them and upload manually.')
+        with self.metrics.call('drive_upload') as call:
+            beneficiaries_file.SetContentFile(src)
+            beneficiaries_file.Upload()
+            call['sent'] = os.path.getsize(src)
+        self.mark_synced(src, self.metadata()[1])
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class PlanCache:
+    """On-disk cache of solved plans, one JSON file in `path` per hash of the
+    canonicalized jobs, vehicles and solve options. Only the `max_entries`
+    most recently used plans are kept."""
+
+    def __init__(self, path=PLAN_CACHE_DIR, max_entries=PLAN_CACHE_SIZE):
+        self.path = path
+        self.max_entries = max_entries
+
+
+    @staticmethod
+    def key(jobs, vehicles, options):
+        canonical = json.dumps({'jobs': jobs, 'vehicles': vehicles, 'options': options},
+                               sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+    def file(self, key):
+        return os.path.join(self.path, f'{key}.json')
+
+
+    def get(self, key):
+        try:
+            with open(self.file(key)) as f:
+                plan = json.load(f)
+        except (OSError, ValueError):
+            return None
+        os.utime(self.file(key))
+        return plan
+
+
+    def put(self, key, plan):
+        os.makedirs(self.path, exist_ok=True)
+        tmp = self.file(f'{key}.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(plan, f)
+        os.replace(tmp, self.file(key))
+        if self.max_entries is not None:
+            files = sorted((os.path.join(self.path, name) for name in os.listdir(self.path)
+                            if name.endswith('.json')),
+                           key=os.path.getmtime)
+            for file in files[:-self.max_entries]:
+                os.remove(file)
+
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class GeocodeCache:
+    """Persistent SQLite cache of geocoding responses, keyed by provider and
+    normalized address text. Entries older than `ttl` seconds are ignored, and
+    the least recently used entries are evicted beyond `max_entries`."""
+
+    def __init__(self,
+                 path=GEOCODE_CACHE_DB,
+                 ttl=GEOCODE_CACHE_TTL,
+                 max_entries=GEOCODE_CACHE_SIZE):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS geocode ('
+                          'provider TEXT NOT NULL, '
+                          'address TEXT NOT NULL, '
+                          'response TEXT NOT NULL, '
+                          'created REAL NOT NULL, '
+                          'accessed REAL NOT NULL, '
+                          'PRIMARY KEY (provider, address))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS geocode_accessed '
+                          'ON geocode (accessed)')
+        self.conn.commit()
+
+
+    def get(self, provider, address):
+        key = normalize_address(address)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute('SELECT response, created FROM geocode '
+                                    'WHERE provider = ? AND address = ?',
+                                    (provider, key)).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                self.conn.execute('DELETE FROM geocode WHERE provider = ? AND address = ?',
+                                  (provider, key))
+                self.conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute('UPDATE geocode SET accessed = ? '
+                              'WHERE provider = ? AND address = ?',
+                              (now, provider, key))
+            self.conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+
+    def put(self, provider, address, response):
+        key = normalize_address(address)
+        now = time.time()
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?, ?)',
+                              (provider, key, json.dumps(response), now, now))
+            if self.max_entries is not None:
+                count = self.conn.execute('SELECT COUNT(*) FROM geocode').fetchone()[0]
+                if count > self.max_entries:
+                    self.conn.execute('DELETE FROM geocode WHERE rowid IN ('
+                                      'SELECT rowid FROM geocode '
+                                      'ORDER BY accessed ASC LIMIT ?)',
+                                      (count - self.max_entries,))
+            self.conn.commit()
+
+
+    def evict_expired(self):
+        if self.ttl is None:
+            return 0
+        with self.lock:
+            cur = self.conn.execute('DELETE FROM geocode WHERE created < ?',
+                                    (time.time() - self.ttl,))
+            self.conn.commit()
+        return cur.rowcount
+
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute('DELETE FROM geocode')
+            self.conn.commit()
+
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM geocode').fetchone()[0]
+
+
+class RateLimiter:
+    """Thread-safe limiter spacing calls at most `qps` per second apart."""
+
+    def __init__(self, qps):
+        self.interval = 1 / qps if qps else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def pooled_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class Metrics:
+    """Thread-safe record of every external call and pipeline stage.
+
+    Each call records its service, status, latency, retries, bytes sent and
+    received, and the time it waited on local throttling or backoff, which
+    is not counted as latency; HTTP attempts made through a tracked session are counted
+    towards the call in progress on the same thread. Each stage records its
+    wall time. Query them with `calls`, `stages` and `summary`, or export
+    them with `to_json` and `to_prometheus`."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+
+    def reset(self):
+        with self.lock:
+            self.call_records = []
+            self.stage_records = []
+
+
+    def track(self, session):
+        """Count HTTP attempts made through the requests `session`."""
+        session.hooks['response'].append(self.count_attempt)
+
+
+    def count_attempt(self, response, *args, **kwargs):
+        """requests response hook updating the call in progress."""
+        call = getattr(self.local, 'call', None)
+        if call is None:
+            return
+        body = response.request.body or b''
+        call['attempts'] += 1
+        call['status'] = response.status_code
+        call['sent'] += len(body) + len(response.request.url)
+        call['received'] += len(response.content)
+
+
+    @contextlib.contextmanager
+    def call(self, service):
+        """Time one logical call to `service`, retries included. The yielded
+        record may be updated with `status`, `ok`, `sent` and `received`."""
+        call = {'service': service, 'status': None, 'ok': None, 'attempts': 0,
+                'sent': 0, 'received': 0, 'waited': 0.0, 'started': time.time()}
+        outer = getattr(self.local, 'call', None)
+        self.local.call = call
+        start = time.perf_counter()
+        try:
+            yield call
+        except BaseException as e:
+            call['status'] = type(e).__name__
+            call['ok'] = False
+            raise
+        finally:
+            call['latency'] = time.perf_counter() - start - call['waited']
+            self.local.call = outer
+            call['retries'] = max(call.pop('attempts') - 1, 0)
+            if call['ok'] is None:
+                call['ok'] = not (isinstance(call['status'], int) and call['status'] >= 400)
+            if call['status'] is None:
+                call['status'] = 'OK'
+            with self.lock:
+                self.call_records.append(call)
+
+
+    @contextlib.contextmanager
+    def waiting(self):
+        """Count the block, e.g. a rate limit or retry backoff, as waiting
+        time of the call in progress on this thread instead of latency."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            call = getattr(self.local, 'call', None)
+            if call is not None:
+                call['waited'] += time.perf_counter() - start
+
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.stage_records.append({'stage': name,
+                                           'seconds': time.perf_counter() - start})
+
+
+    def calls(self, service=None, ok=None):
+        with self.lock:
+            return [c for c in self.call_records
+                    if (service is None or c['service'] == service)
+                    and (ok is None or c['ok'] == ok)]
+
+
+    def stages(self, name=None):
+        with self.lock:
+            return [s for s in self.stage_records if name is None or s['stage'] == name]
+
+
+    def summary(self):
+        """Totals per service and per stage."""
+        services = {}
+        for call in self.calls():
+            services.setdefault(call['service'], []).append(call)
+        stages = {}
+        for stage in self.stages():
+            stages.setdefault(stage['stage'], []).append(stage['seconds'])
+        return {
+            'calls': {
+                service: {
+                    'count': len(calls),
+                    'errors': sum(not c['ok'] for c in calls),
+                    'retries': sum(c['retries'] for c in calls),
+                    'latency_total': sum(c['latency'] for c in calls),
+                    'latency_mean': float(np.mean([c['latency'] for c in calls])),
+                    'latency_p95': float(np.percentile([c['latency'] for c in calls], 95)),
+                    'latency_max': max(c['latency'] for c in calls),
+                    'waited_total': sum(c['waited'] for c in calls),
+                    'sent': sum(c['sent'] for c in calls),
+                    'received': sum(c['received'] for c in calls),
+                }
+                for service, calls in services.items()
+            },
+            'stages': {name: {'count': len(seconds), 'seconds': sum(seconds)}
+                       for name, seconds in stages.items()},
+        }
+
+
+    def to_json(self):
+        return json.dumps({'calls': self.calls(),
+                           'stages': self.stages(),
+                           'summary': self.summary()}, indent=2, default=str)
+
+
+    def to_prometheus(self, prefix=METRICS_PREFIX):
+        """Totals in the Prometheus text exposition format."""
+        counts = {}
+        for call in self.calls():
+            key = (call['service'], str(call['status']))
+            counts[key] = counts.get(key, 0) + 1
+        summary = self.summary()
+        lines = [f'# TYPE {prefix}_api_calls_total counter']
+        lines += [f'{prefix}_api_calls_total{{service="{service}",status="{status}"}} {n}'
+                  for (service, status), n in sorted(counts.items())]
+        for name, kind, field in (('api_retries_total', 'counter', 'retries'),
+                                  ('api_sent_bytes_total', 'counter', 'sent'),
+                                  ('api_received_bytes_total', 'counter', 'received')):
+            lines.append(f'# TYPE {prefix}_{name} {kind}')
+            lines += [f'{prefix}_{name}{{service="{service}"}} {totals[field]}'
+                      for service, totals in summary['calls'].items()]
+        lines.append(f'# TYPE {prefix}_api_latency_seconds summary')
+        for service, totals in summary['calls'].items():
+            lines.append(f'{prefix}_api_latency_seconds_sum{{service="{service}"}} '
+                         f'{totals["latency_total"]}')
+            lines.append(f'{prefix}_api_latency_seconds_count{{service="{service}"}} '
+                         f'{totals["count"]}')
+        lines.append(f'# TYPE {prefix}_api_wait_seconds_total counter')
+        lines += [f'{prefix}_api_wait_seconds_total{{service="{service}"}} '
+                  f'{totals["waited_total"]}'
+                  for service, totals in summary['calls'].items()]
+        lines.append(f'# TYPE {prefix}_stage_seconds summary')
+        for name, totals in summary['stages'].items():
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {totals["seconds"]}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {totals["count"]}')
+        return '\n'.join(lines) + '\n'
+
+
+    def dump(self, path):
+        """Write the metrics to `path`, in the Prometheus text format if it
+        ends in .prom and as JSON otherwise."""
+        with open(path, 'w') as f:
+            f.write(self.to_prometheus() if path.endswith('.prom') else self.to_json())
+
+
+    def print_report(self):
+        summary = self.summary()
+        print(blue('Stages'))
+        for name, totals in sorted(summary['stages'].items(), key=lambda s: -s[1]['seconds']):
+            seconds = totals['seconds']
+            print(f'  {name}: {yellow(f"{seconds:.2f} s")}')
+        print(blue('External calls'))
+        for service, totals in summary['calls'].items():
+            errors = red(totals['errors']) if totals['errors'] else green(0)
+            latency = totals['latency_total']
+            waited = totals['waited_total']
+            print(f'  {service}: {totals["count"]} calls, '
+                  f'{yellow(f"{latency:.2f} s")} + {waited:.2f} s waiting, '
+                  f'{totals["retries"]} retries, {errors} errors, '
+                  f'{totals["received"] / 1024:.0f} KiB received')
+
+
+_default_geocode_cache = None
+
+def default_geocode_cache():
+    global _default_geocode_cache
+    if _default_geocode_cache is None:
+        _default_geocode_cache = GeocodeCache()
+    return _default_geocode_cache
+
+
 def red(string):
     return f'\u001b[31m{string}\u001b[0m'
 
@@ -585,4 +3319,59 @@ def rainbow(num):
     return cols
 
 def aeq(a,b):
-    return (np.abs(a-b) < 10**(-PRECISION) * 0.6)
\ No newline at end of file
+    return (np.abs(a-b) < 10**(-PRECISION) * 0.6)
+
+
+def main(argv=None):
+    """Headless entry point: route a local beneficiaries workbook without
+    Colab or Google Drive, e.g. from a nightly batch job."""
+    parser = argparse.ArgumentParser(description='Plan meal delivery routes.')
+    parser.add_argument('workbook', help='path to the beneficiaries workbook')
+    parser.add_argument('--vehicles', type=int, required=True)
+    parser.add_argument('--capacity', action='append', required=True, metavar='MEAL=N',
+                        help='meal option and per-vehicle capacity, repeatable')
+    parser.add_argument('--time-limit', type=int, required=True, help='seconds')
+    parser.add_argument('--stop-time', type=int, required=True, help='seconds')
+    parser.add_argument('--solver', choices=['ors', 'local'], default='local')
+    parser.add_argument('--matrix', choices=['ors'], default=None)
+    parser.add_argument('--google-key', default=os.environ.get('GOOGLE_API_KEY'))
+    parser.add_argument('--ors-key', default=os.environ.get('ORS_API_KEY'))
+    parser.add_argument('--geocode', action='store_true',
+                        help='look up missing coordinates first')
+    parser.add_argument('--clusters', type=int, default=None)
+    parser.add_argument('--force', action='store_true',
+                        help='solve again even if a plan for the same inputs is cached')
+    parser.add_argument('--map', default=None, help='write the route map to this HTML file')
+    parser.add_argument('--export', default=None, metavar='DIR',
+                        help='write a map, manifest and CSV per vehicle to this directory')
+    parser.add_argument('--metrics', default=None,
+                        help='write call and stage metrics to this file '
+                             '(Prometheus text if it ends in .prom, JSON otherwise)')
+    args = parser.parse_args(argv)
+
+    capacities = {}
+    for capacity in args.capacity:
+        meal, _, num = capacity.rpartition('=')
+        capacities[meal] = int(num)
+    util = Util(args.google_key, args.ors_key, None,
+                args.vehicles, capacities, args.time_limit, args.stop_time,
+                solver=args.solver, matrix=args.matrix,
+                storage=LocalStorage(args.workbook))
+    if not util.valid:
+        return 1
+    if args.geocode:
+        with util.metrics.stage('geocode'):
+            util.geocode()
+    plan = util.get_plan(clusters=args.clusters, force=args.force)
+    if plan is not None and args.map is not None:
+        with util.metrics.stage('render'):
+            util.render_plan(plan, compact=True).save(args.map)
+    if plan is not None and args.export is not None:
+        util.export(plan, path=args.export)
+    if args.metrics is not None:
+        util.metrics.dump(args.metrics)
+    return 0 if plan is not None else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())